@@ -0,0 +1,69 @@
+# Пропускная способность диспетчера текстовых команд.
+# Запуск: python bench/bench_dispatcher.py
+import random
+
+from telebot import types
+
+from common import load_bot, measure, report
+
+bot = load_bot()
+
+NOISE = ['привет всем', 'ахаха', 'кто играет?', 'ну да', '👍', 'го в доту вечером', 'ок',
+         'Я сегодня проиграл все', 'лол', 'кто-нибудь знает как открыть мины?']
+COMMANDS = ['б', 'Баланс', 'бонус', 'ставки', 'отмена', 'го', 'п 100', 'мины 50',
+            '100 к ч 1-18', '50 0 1 2 3 чет']
+
+
+def legacy_route(text):
+    # Прежняя цепочка: lambda-фильтры и каскад сравнений в handle_all_messages
+    if text.lower() in ['б', 'баланс']:
+        return 'balance'
+    if text.lower() == 'бонус':
+        return 'bonus'
+    text = text.strip()
+    if text.lower().startswith('п '):
+        return 'payment'
+    if text.lower() in ['ставки']:
+        return 'bets'
+    if text.lower() == 'отмена':
+        return 'cancel'
+    if text.lower() == 'го':
+        return 'spin'
+    if text.lower().startswith('мины '):
+        return 'mines'
+    parts = text.split()
+    if len(parts) >= 2:
+        try:
+            int(parts[0])
+        except:
+            return None
+        return 'bets'
+    return None
+
+
+def make_update(update_id, text):
+    return types.Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': -100, 'type': 'supergroup'},
+        'from': {'id': update_id % 1000 + 1, 'is_bot': False, 'first_name': 'U'}}})
+
+
+def main():
+    random.seed(1)
+    # Групповой чат: ~80% сообщений — обычная переписка
+    texts = [random.choice(NOISE) if random.random() < 0.8 else random.choice(COMMANDS) for _ in range(200000)]
+    noise = [random.choice(NOISE) for _ in range(200000)]
+    
+    report("legacy chain, mixed", measure(legacy_route, texts), "msg/s")
+    report("resolve_text_command, mixed", measure(bot.resolve_text_command, texts), "msg/s")
+    report("legacy chain, noise only", measure(legacy_route, noise), "msg/s")
+    report("resolve_text_command, noise only", measure(bot.resolve_text_command, noise), "msg/s")
+    
+    # Полный путь TeleBot для шума: middleware + подбор хендлера + диспетчер
+    bot.bot.threaded = False
+    updates = [[make_update(i, random.choice(NOISE))] for i in range(20000)]
+    report("process_new_updates, noise only", measure(bot.bot.process_new_updates, updates, repeat=1), "msg/s")
+
+
+if __name__ == '__main__':
+    main()
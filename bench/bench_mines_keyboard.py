@@ -0,0 +1,111 @@
+# Время рендера клавиатуры мин на клик: пересборка InlineKeyboardMarkup
+# против сборки JSON из общих шаблонов строк по битовой маске.
+# Запуск: python bench/bench_mines_keyboard.py
+import json
+import random
+
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from common import load_bot, measure, report
+
+bot = load_bot()
+
+
+def legacy_reveal_keyboard(game_id, game):
+    keyboard = []
+    grid_size = game.grid_size
+    for row in range(grid_size):
+        row_buttons = []
+        for col in range(grid_size):
+            cell_idx = row * grid_size + col
+            if game.is_revealed(cell_idx):
+                row_buttons.append(InlineKeyboardButton("💎", callback_data="noop"))
+            else:
+                row_buttons.append(InlineKeyboardButton("🟦", callback_data=f"mines_{game_id}_{cell_idx}"))
+        keyboard.append(row_buttons)
+    keyboard.append([
+        InlineKeyboardButton("💰 Забрать", callback_data=f"mines_{game_id}_cashout"),
+        InlineKeyboardButton("❌ Закончить", callback_data=f"mines_{game_id}_end")
+    ])
+    # Сериализация входит в цену: telebot делает ее при отправке
+    return InlineKeyboardMarkup(keyboard).to_json()
+
+
+def legacy_lost_keyboard(game, exploded):
+    keyboard = []
+    grid_size = game.grid_size
+    for row in range(grid_size):
+        row_buttons = []
+        for col in range(grid_size):
+            cell_idx = row * grid_size + col
+            if cell_idx == exploded:
+                row_buttons.append(InlineKeyboardButton("💥", callback_data="noop"))
+            elif game.is_mine(cell_idx):
+                row_buttons.append(InlineKeyboardButton("💣", callback_data="noop"))
+            elif game.is_revealed(cell_idx):
+                row_buttons.append(InlineKeyboardButton("💎", callback_data="noop"))
+            else:
+                row_buttons.append(InlineKeyboardButton("🟦", callback_data="noop"))
+        keyboard.append(row_buttons)
+    return InlineKeyboardMarkup(keyboard).to_json()
+
+
+def safe_cells(game):
+    cells = [cell for cell in range(game.grid_size ** 2) if not game.is_mine(cell)]
+    random.shuffle(cells)
+    return cells
+
+
+def play(render, games):
+    # Открываем все безопасные клетки каждой игры, рендерим после каждого клика
+    clicks = []
+    for game_id, game, cells in games:
+        for cell in cells:
+            clicks.append((game_id, game, cell))
+    
+    def click(args):
+        game_id, game, cell = args
+        game.reveal(cell)
+        render(game_id, game)
+    return clicks, click
+
+
+def fresh_games(count):
+    random.seed(7)
+    games = []
+    for _ in range(count):
+        game = bot.MinesGame(1, 100)
+        games.append((next(bot.mines_game_ids), game, safe_cells(game)))
+    return games
+
+
+def check_equivalence():
+    for game_id, game, cells in fresh_games(50):
+        # Поле проигрыша — после случайного числа открытых клеток
+        lost_after = random.randrange(len(cells))
+        mines = [cell for cell in range(game.grid_size ** 2) if game.is_mine(cell)]
+        for i, cell in enumerate(cells):
+            if i == lost_after:
+                exploded = random.choice(mines)
+                lost = bot.mines_lost_keyboard(game, exploded)
+                assert json.loads(lost) == json.loads(legacy_lost_keyboard(game, exploded))
+            game.reveal(cell)
+            cached = bot.mines_reveal_keyboard(game_id, game)
+            assert json.loads(cached) == json.loads(legacy_reveal_keyboard(game_id, game))
+
+
+def main():
+    check_equivalence()
+    
+    clicks, click = play(legacy_reveal_keyboard, fresh_games(2000))
+    report("InlineKeyboardMarkup rebuild + to_json", measure(click, clicks, repeat=1), "click/s")
+    
+    clicks, click = play(bot.mines_reveal_keyboard, fresh_games(2000))
+    report("JSON from shared row templates", measure(click, clicks, repeat=1), "click/s")
+    
+    ids = list(range(100000))
+    report("initial keyboard from template", measure(bot.mines_initial_keyboard, ids), "games/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Память и задержка проверки клеток: прежние dict-игры против MinesGame.
+# Запуск: python bench/bench_mines_state.py [число игр]
+import random
+import sys
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from common import load_bot, measure, report
+
+bot = load_bot()
+
+
+def legacy_game(user_id, amount):
+    grid_size = bot.GRID_SIZE
+    return str(uuid.uuid4())[:8], {
+        'user_id': user_id,
+        'bet_amount': amount,
+        'mines_count': bot.MINES_COUNT,
+        'grid_size': grid_size,
+        'mine_positions': random.sample(range(grid_size * grid_size), bot.MINES_COUNT),
+        'revealed_cells': [],
+        'current_payout': amount,
+        'created_at': datetime.now()
+    }
+
+
+def slotted_game(user_id, amount):
+    return next(bot.mines_game_ids), bot.MinesGame(user_id, amount)
+
+
+def memory_per_game(factory, count):
+    tracemalloc.start()
+    games = {}
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        game_id, game = factory(i, 100)
+        games[game_id] = game
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used / count, games
+
+
+def legacy_click(game):
+    # Проверки одного клика + 25 проверок при перестроении клавиатуры
+    cell = 7
+    if cell in game['revealed_cells'] or cell in game['mine_positions']:
+        return
+    for cell_idx in range(25):
+        cell_idx in game['mine_positions'] or cell_idx in game['revealed_cells']
+
+
+def slotted_click(game):
+    cell = 7
+    if game.is_revealed(cell) or game.is_mine(cell):
+        return
+    for cell_idx in range(25):
+        game.is_mine(cell_idx) or game.is_revealed(cell_idx)
+
+
+def with_revealed(games, legacy):
+    # Полупройденные игры: по 10 открытых безопасных клеток
+    result = []
+    for game in games:
+        safe = [c for c in range(25) if c != 7 and not (c in game['mine_positions'] if legacy else game.is_mine(c))]
+        for cell in safe[:10]:
+            if legacy:
+                game['revealed_cells'].append(cell)
+            else:
+                game.reveal(cell)
+        result.append(game)
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    random.seed(1)
+    
+    legacy_bytes, legacy_games = memory_per_game(legacy_game, count)
+    slotted_bytes, slotted_games = memory_per_game(slotted_game, count)
+    report(f"dict game, bytes/game ({count} games)", legacy_bytes, "B")
+    report(f"MinesGame, bytes/game ({count} games)", slotted_bytes, "B")
+    
+    legacy_list = with_revealed(list(legacy_games.values())[:20000], legacy=True)
+    slotted_list = with_revealed(list(slotted_games.values())[:20000], legacy=False)
+    report("dict game, clicks/s", measure(legacy_click, legacy_list), "click/s")
+    report("MinesGame, clicks/s", measure(slotted_click, slotted_list), "click/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Рулетка: прежний список ставок-словарей против RouletteBook.
+# Запуск: python bench/bench_roulette_book.py [ставок на пользователя]
+import random
+import sys
+import time
+import tracemalloc
+
+from common import load_bot, measure, report
+
+bot = load_bot()
+
+BET_VALUES = [str(n) for n in range(37)] + ['к', 'ч', 'чет', 'нечет', '1-18', '19-36', '1-12', '5-8']
+
+
+def legacy_settle(bets, roulette_number):
+    # Расчет из прежнего spin_roulette
+    is_red = roulette_number in [1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36]
+    is_black = roulette_number in [2, 4, 6, 8, 10, 11, 13, 15, 17, 20, 22, 24, 26, 28, 29, 31, 33, 35]
+    is_even = roulette_number % 2 == 0 and roulette_number != 0
+    total_win = 0
+    for bet in bets:
+        amount = bet['amount']
+        bet_type = bet['type']
+        bet_value = bet['value']
+        multiplier = 0
+        if bet_type == 'number':
+            if int(bet_value) == roulette_number:
+                multiplier = 36
+        elif bet_type == 'color':
+            if (bet_value == 'red' and is_red) or (bet_value == 'black' and is_black):
+                multiplier = 2
+        elif bet_type == 'evenodd':
+            if bet_value == 'even' and is_even:
+                multiplier = 2
+            elif bet_value == 'odd' and not is_even and roulette_number != 0:
+                multiplier = 2
+        elif bet_type == 'range':
+            start, end = map(int, bet_value.split('-'))
+            if start <= roulette_number <= end:
+                multiplier = 36 / (end - start + 1)
+        if multiplier:
+            total_win += int(amount * multiplier)
+    return total_win
+
+
+def random_bets(count):
+    bets = []
+    for _ in range(count):
+        bet_type, bet_value = bot.parse_roulette_bet(random.choice(BET_VALUES))
+        bets.append({'amount': random.randint(5, 500), 'type': bet_type, 'value': bet_value, 'time': time.time()})
+    return bets
+
+
+def build_book(bets):
+    book = bot.RouletteBook()
+    for bet in bets:
+        book.add(bet['amount'], bet['type'], bet['value'])
+    return book
+
+
+def memory(factory, users):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = [factory() for _ in range(users)]
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used / users, kept
+
+
+def main():
+    per_user = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    random.seed(1)
+
+    # Выплаты книги должны совпадать с прежним расчетом на каждом числе
+    for _ in range(200):
+        bets = random_bets(random.randint(1, 60))
+        book = build_book(bets)
+        for number in range(37):
+            assert book.payout(number) == legacy_settle(bets, number), (bets, number)
+    print("payouts match legacy settlement")
+
+    samples = [random_bets(per_user) for _ in range(20)]
+    legacy_bytes, _ = memory(lambda: random_bets(per_user), 1000)
+    book_bytes, _ = memory(lambda: build_book(random.choice(samples)), 1000)
+    report(f"list of dicts, bytes/user ({per_user} bets)", legacy_bytes, "B")
+    report(f"RouletteBook, bytes/user ({per_user} bets)", book_bytes, "B")
+
+    spins = [(random.choice(samples), random.randint(0, 36)) for _ in range(2000)]
+    books = {id(bets): build_book(bets) for bets in samples}
+    report("legacy settlement, spins/s", measure(lambda item: legacy_settle(*item), spins), "spin/s")
+    report("RouletteBook settlement, spins/s",
+           measure(lambda item: books[id(item[0])].payout(item[1]), spins), "spin/s")
+
+
+if __name__ == '__main__':
+    main()
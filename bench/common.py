@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+import time
+
+
+def load_bot(**env):
+    # bot.py читает окружение при импорте: подставляем фиктивный токен и временную БД
+    os.environ.setdefault('BOT_TOKEN', '0:bench')
+    os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(prefix='casino-bench-'), 'bench.db'))
+    os.environ.update(env)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bot
+    return bot
+
+
+def measure(fn, items, repeat=3):
+    # Лучший из нескольких прогонов, операций в секунду
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(items) / best
+
+
+def report(name, value, unit):
+    print(f"{name:<48} {value:>14,.0f} {unit}")
@@ -0,0 +1,160 @@
+# Локальная замена Bot API для нагрузочных тестов: getUpdates (long polling),
+# sendMessage, editMessageText, answerCallbackQuery, а также getMe, getChat и
+# deleteWebhook, которые бот вызывает при старте. Задержка ответа и доля
+# ответов 429 настраиваются.
+# Отдельный запуск: python bench/fake_bot_api.py [--port 8081] [--latency мс] [--rate-limit доля]
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_ID = 999
+MINES_BUTTON = re.compile(r'"callback_data":\s*"(mines_\d+_(?:\d+|cashout))"')
+OUTGOING = ('sendMessage', 'editMessageText', 'answerCallbackQuery')
+
+
+class FakeBotApi:
+    def __init__(self, port=8081, latency=0.0, rate_limit=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.updates = deque()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(100)
+        self.cond = threading.Condition()
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.limited = {}
+        # Последняя клавиатура игры в мины по чату: (message_id, [callback_data])
+        self.mines_keyboards = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler_class())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    @property
+    def api_url(self):
+        # Формат apihelper.API_URL: {0} — токен, {1} — метод
+        return f"http://127.0.0.1:{self.port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def push(self, update):
+        update['update_id'] = next(self.update_ids)
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify()
+
+    def get_updates(self, params):
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        # Смещение не нужно: выдача из очереди уже подтверждает получение
+        with self.cond:
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.cond.wait(remaining)
+            return [self.updates.popleft() for _ in range(min(limit, len(self.updates)))]
+
+    def remember_keyboard(self, chat_id, message_id, markup):
+        buttons = MINES_BUTTON.findall(markup or '')
+        with self.lock:
+            if buttons:
+                self.mines_keyboards[chat_id] = (message_id, buttons)
+            elif chat_id in self.mines_keyboards and self.mines_keyboards[chat_id][0] == message_id:
+                del self.mines_keyboards[chat_id]
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+
+        if self.latency:
+            time.sleep(self.latency)
+        if method in OUTGOING and self.rate_limit and random.random() < self.rate_limit:
+            with self.lock:
+                self.limited[method] = self.limited.get(method, 0) + 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f"Too Many Requests: retry after {self.retry_after}",
+                         'parameters': {'retry_after': self.retry_after}}
+
+        if method == 'getMe':
+            result = {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getChat':
+            chat_id = int(params['chat_id'])
+            result = {'id': chat_id, 'type': 'private', 'first_name': f'U{chat_id}', 'username': f'user{chat_id}'}
+        elif method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            message_id = next(self.message_ids)
+            self.remember_keyboard(chat_id, message_id, params.get('reply_markup'))
+            result = {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                      'chat': {'id': chat_id, 'type': 'private'}}
+        elif method == 'editMessageText':
+            self.remember_keyboard(int(params['chat_id']), int(params['message_id']), params.get('reply_markup'))
+            result = True
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят отдельными write: без этого Nagle + delayed ACK дают ~40 мс на запрос
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if body:
+                    if 'json' in self.headers.get('Content-Type', ''):
+                        params.update(json.loads(body))
+                    else:
+                        params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+
+                status, payload = api.call(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный фейковый Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help="задержка ответа, мс")
+    parser.add_argument('--rate-limit', type=float, default=0, help="доля ответов 429 на исходящие методы")
+    args = parser.parse_args()
+    api = FakeBotApi(args.port, args.latency / 1000, args.rate_limit)
+    print(f"Fake Bot API: {api.api_url}")
+    api.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# Нагрузочный тест бота целиком: настоящий polling, хендлеры, SQLite и HTTP к
+# локальному фейковому Bot API (bench/fake_bot_api.py). Генератор проигрывает
+# смесь типичных действий тысяч пользователей: баланс, переводы, ставки в
+# рулетку, «го» и игры в мины с нажатием кнопок из присланной клавиатуры.
+# Запуск: python bench/load_test.py [--users 2000] [--updates 20000] [--latency мс] [--rate-limit доля] [--runtime sync|async]
+import argparse
+import os
+import random
+import threading
+import time
+
+from common import load_bot, report
+from fake_bot_api import FakeBotApi
+
+# Доли действий в потоке обновлений
+MIX = [
+    ('balance', 30),
+    ('payment', 15),
+    ('bet', 25),
+    ('spin', 10),
+    ('mines', 5),
+    ('mines_click', 15),
+]
+BET_VALUES = ['7', '0', '17', 'к', 'ч', 'чет', 'нечет', '1-18', '19-36', '1-12']
+
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'U{user_id}', 'username': f'user{user_id}'}
+
+
+def message_update(user_id, text):
+    return {'message': {'message_id': random.randrange(1, 1 << 30), 'date': int(time.time()), 'text': text,
+                        'chat': {'id': user_id, 'type': 'private'}, 'from': user(user_id)}}
+
+
+def callback_update(user_id, message_id, data):
+    return {'callback_query': {'id': str(random.randrange(1 << 40)), 'data': data, 'chat_instance': 'bench',
+                               'from': user(user_id),
+                               'message': {'message_id': message_id, 'date': int(time.time()), 'text': 'mines',
+                                           'chat': {'id': user_id, 'type': 'private'}}}}
+
+
+def next_update(api, users):
+    user_id = random.choice(users)
+    action = random.choices([name for name, _ in MIX], [weight for _, weight in MIX])[0]
+    if action == 'mines_click':
+        keyboard = api.mines_keyboards.get(user_id)
+        if keyboard is None:
+            action = 'mines'
+        else:
+            message_id, buttons = keyboard
+            return callback_update(user_id, message_id, random.choice(buttons))
+
+    if action == 'balance':
+        text = 'б'
+    elif action == 'payment':
+        text = f"п {random.choice(users)} {random.randint(1, 100)}"
+    elif action == 'bet':
+        text = f"{random.randint(10, 500)} {random.choice(BET_VALUES)}"
+    elif action == 'spin':
+        text = 'го'
+    else:
+        text = f"мины {random.randint(10, 200)}"
+    return message_update(user_id, text)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def histogram_count(histogram):
+    with histogram.lock:
+        return sum(sum(counts) for counts, _ in histogram.series.values())
+
+
+def counter_total(counter):
+    with counter.lock:
+        return sum(counter.values.values())
+
+
+def wait_outbox_drained(outbox, timeout):
+    # Ответы, еще ждущие лимита чата, тоже запросы этого прогона: считаем после отправки
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with outbox.lock:
+            if not any(chat.jobs or chat.active for chat in outbox.chats.values()):
+                return True
+        time.sleep(0.05)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковом Bot API")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--window', type=int, default=200, help="обновлений в обработке одновременно")
+    parser.add_argument('--latency', type=float, default=5, help="задержка ответа Bot API, мс")
+    parser.add_argument('--rate-limit', type=float, default=0, help="доля ответов 429")
+    parser.add_argument('--runtime', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    api = FakeBotApi(0, args.latency / 1000, args.rate_limit).start()
+
+    # Под насыщением медленные все обновления: предупреждения только о совсем долгих
+    bot = load_bot(BOT_RUNTIME=args.runtime, BOT_MODE='polling', METRICS_PORT='0',
+                   SLOW_UPDATE_SECONDS=os.environ.get('SLOW_UPDATE_SECONDS', '10'))
+    from telebot import apihelper, asyncio_helper
+    apihelper.API_URL = api.api_url
+    asyncio_helper.API_URL = api.api_url
+
+    users = list(range(10_000, 10_000 + args.users))
+    for user_id in users:
+        bot.get_user(user_id)
+        bot.set_user_balance(user_id, 1_000_000)
+
+    # Время каждого обновления берется из трассировки бота (см. UpdateTrace)
+    handler_times = []
+    total_times = []
+    finished = threading.Semaphore(0)
+    finish = bot.UpdateTrace.finish
+
+    def record(trace, end):
+        finish(trace, end)
+        handler_times.append(end - trace.start)
+        if trace.received_at is not None:
+            total_times.append(end - trace.received_at)
+        finished.release()
+
+    bot.UpdateTrace.finish = record
+    threading.Thread(target=bot.main, name="bot-main", daemon=True).start()
+
+    commits_before = histogram_count(bot.ledger_commit_seconds)
+    ops_before = histogram_count(bot.ledger_op_seconds)
+    calls_before = sum(api.calls.values()) - api.calls.get('getUpdates', 0)
+    dropped_before = counter_total(bot.outbox_dropped)
+    coalesced_before = counter_total(bot.outbox_coalesced)
+    start = time.perf_counter()
+    window = threading.Semaphore(args.window)
+
+    def release_window():
+        for _ in range(args.updates):
+            finished.acquire()
+            window.release()
+
+    releaser = threading.Thread(target=release_window, daemon=True)
+    releaser.start()
+    for _ in range(args.updates):
+        window.acquire()
+        api.push(next_update(api, users))
+    releaser.join(timeout=300)
+    elapsed = time.perf_counter() - start
+
+    # Операции леджера, поставленные в очередь без ожидания, успевают закоммититься
+    time.sleep(0.5)
+    drain_start = time.perf_counter()
+    drained = wait_outbox_drained(bot.outbox, bot.OUTBOX_SEND_TTL * 2)
+    drain_seconds = time.perf_counter() - drain_start
+    commits = histogram_count(bot.ledger_commit_seconds) - commits_before
+    ops = histogram_count(bot.ledger_op_seconds) - ops_before
+    requests = sum(api.calls.values()) - api.calls.get('getUpdates', 0) - calls_before
+    done = len(handler_times)
+
+    print(f"runtime {args.runtime}, {args.users} users, {done}/{args.updates} updates, "
+          f"latency {args.latency:g} ms, 429 rate {args.rate_limit:g}")
+    report("throughput", done / elapsed, "upd/s")
+    report("handler latency p50", percentile(handler_times, 0.50) * 1e6, "µs")
+    report("handler latency p99", percentile(handler_times, 0.99) * 1e6, "µs")
+    report("receive-to-done latency p50", percentile(total_times, 0.50) * 1e6, "µs")
+    report("receive-to-done latency p99", percentile(total_times, 0.99) * 1e6, "µs")
+    print(f"{'DB commits per update':<48} {commits / max(done, 1):>14.3f}")
+    print(f"{'ledger ops per commit':<48} {ops / max(commits, 1):>14.2f}")
+    print(f"{'Bot API requests per update':<48} {requests / max(done, 1):>14.2f}")
+    print(f"{'429 responses':<48} {sum(api.limited.values()):>14}")
+    print(f"{'outbox dropped':<48} {counter_total(bot.outbox_dropped) - dropped_before:>14}")
+    print(f"{'outbox coalesced edits':<48} {counter_total(bot.outbox_coalesced) - coalesced_before:>14}")
+    print(f"{'outbox drain after last update, s':<48} {drain_seconds:>14.2f}"
+          + ("" if drained else "  (не опустела)"))
+
+
+if __name__ == '__main__':
+    main()
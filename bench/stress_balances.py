@@ -0,0 +1,167 @@
+# Стресс-тест параллельных обработчиков: переводы, мины и ставки одних и тех же
+# пользователей из многих потоков. Проверяет, что балансы не уходят в минус,
+# переводы сохраняют сумму денег, игра в мины и бонус выплачиваются ровно
+# один раз, а game_state совпадает с памятью и не воскрешает рассчитанные игры.
+# Запуск: python bench/stress_balances.py [потоков]
+import itertools
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import types
+
+from common import load_bot
+
+bot = load_bot()
+
+message_ids = itertools.count(1000)
+update_ids = itertools.count(1)
+
+
+class Sent:
+    def __init__(self, chat_id):
+        self.chat = types.Chat(chat_id, 'private')
+        self.message_id = next(message_ids)
+
+
+class Profile:
+    id = 1
+    username = 'bench'
+    first_name = 'Bench'
+
+
+def silence():
+    # Ответы в Telegram не нужны: подменяем методы отправки на заглушки
+    bot.bot.reply_to = lambda message, *args, **kwargs: Sent(message.chat.id)
+    bot.bot.send_message = lambda chat_id, *args, **kwargs: Sent(chat_id)
+    bot.bot.edit_message_text = lambda *args, **kwargs: True
+    bot.bot.answer_callback_query = lambda *args, **kwargs: True
+    bot.bot.get_me = lambda: Profile()
+    bot.bot.get_chat = lambda chat_id: Profile()
+
+
+def message(user_id, text):
+    return types.Message.de_json({
+        'message_id': next(message_ids), 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'U{user_id}'}})
+
+
+def callback(user_id, data):
+    return types.CallbackQuery.de_json({
+        'id': str(next(update_ids)), 'data': data, 'chat_instance': 'bench',
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'U{user_id}'},
+        'message': {'message_id': next(message_ids), 'date': 0, 'text': 'x',
+                    'chat': {'id': user_id, 'type': 'private'}}})
+
+
+def process_update(update):
+    # Через диспетчер TeleBot: важно, какой хендлер сработает и под какой блокировкой
+    bot.bot.process_new_updates([update])
+
+
+def update(event):
+    key = 'message' if isinstance(event, types.Message) else 'callback_query'
+    return types.Update.de_json({'update_id': next(update_ids), key: event.json})
+
+
+def run(pool, jobs):
+    start = time.perf_counter()
+    for future in [pool.submit(fn, arg) for fn, arg in jobs]:
+        future.result()
+    return time.perf_counter() - start
+
+
+def balances(users):
+    return {user_id: bot.db_read("SELECT balance FROM users WHERE user_id = ?", (user_id,))[0] for user_id in users}
+
+
+def stored_book(user_id):
+    row = bot.db_read("SELECT state FROM game_state WHERE kind = 'roulette' AND id = 0 AND user_id = ?", (user_id,))
+    return bot.RouletteBook.from_state(json.loads(row[0])) if row else bot.RouletteBook()
+
+
+def check(name, ok, detail=''):
+    print(f"{'OK  ' if ok else 'FAIL'} {name} {detail}")
+    return ok
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    random.seed(1)
+    silence()
+    bot.bot.threaded = False
+    ok = True
+    users = list(range(100, 120))
+    for user_id in users:
+        bot.get_user(user_id)
+        bot.set_user_balance(user_id, 1000)
+
+    with ThreadPoolExecutor(threads) as pool:
+        # Переводы: каждый пытается отдать больше, чем у него есть
+        jobs = [(bot.handle_all_messages, message(random.choice(users), f"п {random.choice(users)} {random.randint(1, 700)}"))
+                for _ in range(3000)]
+        jobs = [(fn, msg) for fn, msg in jobs if msg.text.split()[1] != str(msg.from_user.id)]
+        elapsed = run(pool, jobs)
+        result = balances(users)
+        ok &= check("transfers: no negative balances", min(result.values()) >= 0, f"(min {min(result.values())})")
+        ok &= check("transfers: money supply preserved", sum(result.values()) == 1000 * len(users),
+                    f"({sum(result.values())}, {len(jobs) / elapsed:,.0f} msg/s)")
+
+        # Ставки: 50 одновременных ставок на весь баланс — пройти может только одна
+        for user_id in users:
+            bot.set_user_balance(user_id, 100)
+        jobs = [(bot.handle_all_messages, message(user_id, "100 7")) for user_id in users for _ in range(50)]
+        random.shuffle(jobs)
+        run(pool, jobs)
+        result = balances(users)
+        staked = {user_id: bot.get_user_roulette_book(user_id).total for user_id in users}
+        ok &= check("roulette: no negative balances", min(result.values()) >= 0)
+        ok &= check("roulette: stakes never exceed funds", all(staked[u] + result[u] == 100 for u in users),
+                    f"(max staked {max(staked.values())})")
+        stored = {user_id: stored_book(user_id).total for user_id in users}
+        ok &= check("roulette: stored bets match stakes", stored == staked)
+        for user_id in users:
+            bot.settle_user_roulette_bets(user_id, 0)
+
+        # Мины: одна игра на пользователя, 20 одновременных нажатий «Забрать»
+        # вперемешку с закрытием по таймеру — выплата должна пройти один раз
+        for user_id in users:
+            bot.set_user_balance(user_id, 500)
+        run(pool, [(bot.handle_all_messages, message(user_id, "мины 100")) for user_id in users])
+        games = {game.user_id: game_id for game_id, game in list(bot.mines_games.items())}
+        for game_id in games.values():
+            bot.mines_games[game_id].touched_at -= bot.MINES_GAME_TTL
+        jobs = [(bot.handle_callback, callback(user_id, f"mines_{game_id}_cashout"))
+                for user_id, game_id in games.items() for _ in range(20)]
+        jobs += [(bot.expire_mines_game, game_id) for game_id in games.values() for _ in range(5)]
+        random.shuffle(jobs)
+        run(pool, jobs)
+        result = balances(users)
+        ok &= check("mines: every game settled once", all(result[u] == 500 for u in users),
+                    f"(balances {sorted(set(result.values()))})")
+        ok &= check("mines: no games left open", not any(game_id in bot.mines_games for game_id in games.values()))
+        # Рестарт после расчета: закрытые игры не должны вернуться из game_state
+        bot.load_game_state()
+        ok &= check("mines: settled games not restored after restart",
+                    not any(bot.get_mines_game(game_id) for game_id in games.values()))
+
+        # Бонус: команда «бонус» и кнопка одновременно — начисление должно быть одно
+        fresh = list(range(1000, 1200))
+        for user_id in fresh:
+            bot.get_user(user_id)
+        before = balances(fresh)
+        jobs = [(process_update, update(event)) for user_id in fresh
+                for event in (message(user_id, "бонус"), callback(user_id, "daily_bonus"))]
+        run(pool, jobs)
+        result = balances(fresh)
+        ok &= check("bonus: credited once", all(result[u] - before[u] == bot.DAILY_BONUS for u in fresh),
+                    f"(credited {sorted(set(result[u] - before[u] for u in fresh))})")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,30 @@
+import asyncio
+import bisect
+import functools
+import heapq
+import hmac
+import json
 import os
+import queue
 import random
+import requests
+import secrets
 import sqlite3
+import sys
 import telebot
+from telebot import apihelper
 import time
 import threading
-import uuid
+import itertools
 from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
 from datetime import datetime, timedelta
 import atexit
 import logging
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, abort
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -24,18 +40,501 @@ GRID_SIZE = 5
 DAILY_BONUS = 2500
 ROULETTE_COOLDOWN = 10
 
+DB_PATH = os.environ.get('DB_PATH', 'casino_mega.db')
+DB_CACHE_KB = 16000
+DB_MMAP_SIZE = 256 * 1024 * 1024
+USER_CACHE_SIZE = 10000
+
+# Лидерборд: сколько мест кэшируется и сколько показывается игрокам
+LEADERBOARD_SIZE = 20
+LEADERBOARD_PUBLIC = 10
+
+# Поиск пользователей (/finduser)
+FINDUSER_PAGE = 10
+FINDUSER_SESSIONS = 1000
+
+# Режим приема обновлений: polling (по умолчанию) или webhook.
+# Без WEBHOOK_SECRET вебхук не запускается; если задан WEBHOOK_URL, секрет
+# генерируется при старте и передается в set_webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+PORT = int(os.environ.get('PORT', '8080'))
+UPDATE_QUEUE_SIZE = 1000
+
+# Потоки обработчиков TeleBot; команды одного пользователя сериализуются
+# полосатыми блокировками, поэтому потоков можно держать много.
+# В режиме webhook хендлеры выполняют UPDATE_WORKERS потоков вебхука
+BOT_THREADS = int(os.environ.get('BOT_THREADS', '8'))
+UPDATE_WORKERS = BOT_THREADS
+USER_LOCK_STRIPES = 256
+
+# Рантайм: threads (TeleBot) или async (AsyncTeleBot, нужен aiohttp)
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'threads').lower()
+ASYNC_HANDLER_THREADS = 8
+ASYNC_MAX_INFLIGHT = 5000
+
+# Рассылка: глобальный лимит Telegram ~30 сообщений/сек
+BROADCAST_RATE = 30
+BROADCAST_CHUNK = 200
+BROADCAST_WORKERS = 8
+BROADCAST_MAX_RETRIES = 5
+
+# Исходящая очередь: Telegram ограничивает сообщения в одном чате — около
+# 1 в секунду в личке и 20 в минуту в группе. Небольшой всплеск допускается,
+# ожидающие правки одного сообщения сливаются в одну. Очередь чата ограничена
+# OUTBOX_CHAT_LIMIT, сообщения старше OUTBOX_SEND_TTL секунд не отправляются
+OUTBOX_PRIVATE_RATE = 1.0
+OUTBOX_PRIVATE_BURST = 3
+OUTBOX_GROUP_RATE = 20 / 60
+OUTBOX_GROUP_BURST = 3
+OUTBOX_CHAT_LIMIT = 20
+OUTBOX_SEND_TTL = 30
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '16'))
+
+# Потоки отложенных задач (таймеры игр, раунды столов, очистка)
+SCHEDULER_WORKERS = 4
+
+# Исходящие запросы к Bot API: пул keep-alive соединений на все рабочие потоки
+# (хендлеры или потоки вебхука, рассылка, исходящая очередь и служебные), таймауты по методу, повторы
+TELEGRAM_POOL_SIZE = max(BOT_THREADS, UPDATE_WORKERS) + BROADCAST_WORKERS + OUTBOX_WORKERS + SCHEDULER_WORKERS + 4
+TELEGRAM_MAX_RETRIES = 3
+TELEGRAM_RETRY_BACKOFF = 0.5
+# Дольше поток хендлера не ждет: 429 с большим retry_after уходит вызывающему
+TELEGRAM_RETRY_AFTER_MAX = 5
+TELEGRAM_CONNECT_TIMEOUT = 3.05
+TELEGRAM_READ_TIMEOUTS = {
+    'sendMessage': 10,
+    'editMessageText': 10,
+    'answerCallbackQuery': 5,
+    'getChat': 5,
+    'getMe': 5,
+}
+# Повтор после сетевой ошибки или 5xx безопасен только для этих методов:
+# sendMessage мог дойти до Telegram, и повтор продублировал бы сообщение
+TELEGRAM_IDEMPOTENT = frozenset(('getMe', 'getChat', 'getUpdates', 'editMessageText', 'answerCallbackQuery',
+                                 'deleteWebhook', 'setWebhook', 'getWebhookInfo'))
+
+# Доставка: как часто сбрасывать last_seen и пометки недоступных чатов
+DELIVERY_FLUSH_INTERVAL = 5
+DEAD_CHAT_ERRORS = ('bot was blocked', 'user is deactivated', 'chat not found', 'bot was kicked', 'bot can\'t initiate')
+
+# Кэш профилей чатов из get_chat
+CHAT_CACHE_SIZE = 5000
+CHAT_CACHE_TTL = 600
+CHAT_NEGATIVE_TTL = 60
+
+# Незавершенные игры хранятся в таблице game_state; ходы в минах пишутся раз в
+# MINES_PROGRESS_INTERVAL секунд
+MINES_PROGRESS_INTERVAL = 2
+
+# Group commit: операции, пришедшие за это окно, фиксируются одним COMMIT
+LEDGER_COMMIT_WINDOW = 0.003
+LEDGER_BATCH_MAX = 256
+
+# Брошенные игры в мины: через MINES_GAME_TTL секунд без ходов игра закрывается
+# выплатой текущего выигрыша (cashout) или сгорает (forfeit)
+MINES_GAME_TTL = int(os.environ.get('MINES_GAME_TTL', '1800'))
+MINES_EXPIRE_ACTION = os.environ.get('MINES_EXPIRE_ACTION', 'cashout').lower()
+BONUS_FLAG_TTL = 3600
+EXPIRY_SWEEP_INTERVAL = 60
+
+# Столы рулетки в группах: ставки чата крутятся общим раундом раз в ROULETTE_COOLDOWN
+ROULETTE_TABLES = os.environ.get('ROULETTE_TABLES', '0') == '1'
+ROULETTE_TABLE_WINNERS_SHOWN = 20
+
+# Метрики Prometheus на локальном порту (0 — не запускать)
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9108'))
+
+# Трассировка: обновления дольше порога пишутся в лог с разбивкой по стадиям
+SLOW_UPDATE_SECONDS = float(os.environ.get('SLOW_UPDATE_SECONDS', '1.0'))
+
+# Профилировщик /profile: частота выборок, предел длительности, куда писать стеки
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.dirname(os.path.abspath(DB_PATH)))
+
+START_TIME = time.time()
+
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не установлен!")
     exit(1)
 
-bot = telebot.TeleBot(BOT_TOKEN)
+apihelper.ENABLE_MIDDLEWARE = True
+bot = telebot.TeleBot(BOT_TOKEN, num_threads=BOT_THREADS)
 conn = None
+db_lock = threading.RLock()
+ledger_queue = queue.Queue()
+
+# Соединения на чтение: по одному на поток, только чтение
+read_local = threading.local()
+read_conns = []
+read_conns_lock = threading.Lock()
+
+# LRU-кэш строк users (write-through из леджера)
+USER_FIELDS = {'balance': 1, 'username': 2, 'first_name': 3, 'last_name': 4, 'last_bonus': 5}
+user_cache = OrderedDict()
+user_cache_lock = threading.Lock()
+user_cache_gen = 0
+user_cache_stats = {'hits': 0, 'misses': 0}
+
+# МЕТРИКИ
+# Реестр в текстовом формате Prometheus. Наблюдение — bisect и пара сложений
+# под замком метрики, поэтому метрики можно держать включенными всегда.
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metrics_registry = []
+
+def _format_labels(names, values, extra=None):
+    pairs = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="' + str(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+class Gauge:
+    # Значение снимается в момент запроса /metrics
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        metrics_registry.append(self)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {value}"
+
+def render_metrics():
+    return '\n'.join(line for metric in metrics_registry for line in metric.render()) + '\n'
+
+handler_seconds = Histogram('casino_handler_seconds', 'Время работы хендлера', ('handler',))
+handler_errors = Counter('casino_handler_errors_total', 'Исключения в хендлерах', ('handler',))
+db_query_seconds = Histogram('casino_db_query_seconds', 'Время запроса на чтение к SQLite', ('query',))
+ledger_op_seconds = Histogram('casino_ledger_op_seconds', 'Время операции леджера внутри транзакции', ('op',))
+ledger_commit_seconds = Histogram('casino_ledger_commit_seconds', 'Время COMMIT пакета леджера')
+ledger_wait_seconds = Histogram('casino_ledger_wait_seconds', 'Время от постановки операции в очередь до COMMIT')
+ledger_batch_size = Histogram('casino_ledger_batch_size', 'Операций в одном COMMIT', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+telegram_request_seconds = Histogram('casino_telegram_request_seconds', 'Время запроса к Bot API', ('method',))
+telegram_errors = Counter('casino_telegram_errors_total', 'Ошибки запросов к Bot API', ('method', 'code'))
+update_stage_seconds = Histogram('casino_update_stage_seconds', 'Время обновления по стадиям', ('stage',))
+outbox_coalesced = Counter('casino_outbox_coalesced_total', 'Правки, слитые с ожидающей правкой того же сообщения')
+outbox_delayed = Counter('casino_outbox_delayed_total', 'Отправки, отложенные лимитом чата', ('chat_type',))
+outbox_dropped = Counter('casino_outbox_dropped_total', 'Сообщения, отброшенные исходящей очередью', ('reason',))
+
+# ТРАССИРОВКА ОБНОВЛЕНИЙ
+# Трасса живет в потоке хендлера от входа в первый хендлер до выхода из него.
+# БД, Telegram и ожидание блокировки добавляют к ней свое время, остаток —
+# работа самого хендлера (разбор аргументов, тексты, клавиатуры) — это render.
+# queue — от получения обновления до начала обработки.
+trace_local = threading.local()
+
+def trace_span(stage, seconds):
+    trace = getattr(trace_local, 'trace', None)
+    if trace is not None:
+        trace.spans[stage] += seconds
+
+class UpdateTrace:
+    __slots__ = ('name', 'start', 'received_at', 'parsed_in', 'spans')
+
+    def __init__(self, name, start, event):
+        self.name = name
+        self.start = start
+        self.received_at = getattr(event, 'received_at', None)
+        self.parsed_in = getattr(event, 'parse_seconds', 0.0)
+        self.spans = {'parse': 0.0, 'lock': 0.0, 'db': 0.0, 'send': 0.0}
+
+    def finish(self, end):
+        spans = self.spans
+        spans['render'] = max(0.0, end - self.start - sum(spans.values()))
+        spans['parse'] += self.parsed_in
+        total = end - self.start + self.parsed_in
+        if self.received_at is not None:
+            spans['queue'] = max(0.0, self.start - self.received_at)
+            total = end - self.received_at + self.parsed_in
+        
+        for stage, seconds in spans.items():
+            update_stage_seconds.observe(seconds, stage)
+        if total >= SLOW_UPDATE_SECONDS:
+            breakdown = ', '.join(f"{stage} {seconds * 1000:.0f}" for stage, seconds in spans.items())
+            logger.warning(f"🐢 Медленное обновление {self.name}: {total * 1000:.0f} мс ({breakdown})")
+
+class HandlerTimer:
+    __slots__ = ('name', 'event', 'start', 'trace')
+
+    def __init__(self, name, event=None):
+        self.name = name
+        self.event = event
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        trace = getattr(trace_local, 'trace', None)
+        if trace is None:
+            self.trace = trace_local.trace = UpdateTrace(self.name, self.start, self.event)
+        else:
+            # Вложенный хендлер: трасса получает более точное имя
+            self.trace = None
+            trace.name = self.name
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        handler_seconds.observe(end - self.start, self.name)
+        if exc_type:
+            handler_errors.inc(self.name)
+        if self.trace is not None:
+            trace_local.trace = None
+            self.trace.finish(end)
+
+def timed_handler(fn):
+    name = fn.__name__
+    
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with HandlerTimer(name, args[0] if args else None):
+            return fn(*args, **kwargs)
+    return wrapper
+
+query_labels = {}
+
+def _query_label(query):
+    # Запросы в коде статичные, поэтому набор меток ограничен
+    label = query_labels.get(query)
+    if label is None:
+        label = query_labels[query] = ' '.join(query.split())
+    return label
+
+# Одна сессия на процесс вместо сессии на поток: соединения переиспользуются
+# всеми потоками, размер пула — по числу потоков, которые шлют запросы
+telegram_session = requests.Session()
+for prefix in ('https://', 'http://'):
+    telegram_session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_SIZE))
+
+def _telegram_timeout(api_method, timeout):
+    # Для getUpdates telebot сам считает таймаут с учетом long polling
+    read_timeout = TELEGRAM_READ_TIMEOUTS.get(api_method)
+    if read_timeout is None:
+        return timeout
+    return (TELEGRAM_CONNECT_TIMEOUT, read_timeout)
+
+def _retry_delay(attempt, retry_after=None):
+    # Джиттер, чтобы потоки, получившие 429 одновременно, не повторяли разом
+    if retry_after is not None:
+        return retry_after + random.uniform(0, TELEGRAM_RETRY_BACKOFF)
+    return random.uniform(0, TELEGRAM_RETRY_BACKOFF * 2 ** attempt)
+
+def _response_retry_after(response):
+    try:
+        return (response.json().get('parameters') or {}).get('retry_after', 1)
+    except ValueError:
+        return 1
+
+def telegram_request_sender(method, url, **kwargs):
+    # Запрос apihelper через общий пул с таймаутом по методу. 429 повторяется
+    # после retry_after для всех методов (Telegram запрос не выполнил), сетевые
+    # ошибки и 5xx — только для идемпотентных; таймаут соединения — для всех
+    api_method = url.rsplit('/', 1)[-1]
+    kwargs['timeout'] = _telegram_timeout(api_method, kwargs.get('timeout'))
+    idempotent = api_method in TELEGRAM_IDEMPOTENT
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            response = telegram_session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            telegram_errors.inc(api_method, type(e).__name__)
+            if attempt >= TELEGRAM_MAX_RETRIES or not (idempotent or isinstance(e, requests.ConnectTimeout)):
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning(f"Bot API {api_method}: {type(e).__name__}, повтор через {delay:.1f} сек.")
+        else:
+            if response.status_code == 200:
+                return response
+            telegram_errors.inc(api_method, str(response.status_code))
+            
+            delay = None
+            if response.status_code == 429:
+                retry_after = _response_retry_after(response)
+                if retry_after <= TELEGRAM_RETRY_AFTER_MAX:
+                    delay = _retry_delay(attempt, retry_after)
+            elif response.status_code >= 500 and idempotent:
+                delay = _retry_delay(attempt)
+            if delay is None or attempt >= TELEGRAM_MAX_RETRIES:
+                return response
+            logger.warning(f"Bot API {api_method}: HTTP {response.status_code}, повтор через {delay:.1f} сек.")
+        finally:
+            elapsed = time.perf_counter() - start
+            telegram_request_seconds.observe(elapsed, api_method)
+            trace_span('send', elapsed)
+        
+        time.sleep(delay)
+        trace_span('send', delay)
+        attempt += 1
+
+apihelper.CUSTOM_REQUEST_SENDER = telegram_request_sender
+
+def _tune_connection(connection):
+    c = connection.cursor()
+    c.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+    c.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    c.execute("PRAGMA temp_store = MEMORY")
+
+def _add_column(c, table, column, decl):
+    columns = [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def init_stats(c):
+    # Счетчики для /status поддерживаются триггерами в той же транзакции, что и запись
+    c.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    c.execute('''CREATE TABLE IF NOT EXISTS transaction_stats
+                (type TEXT PRIMARY KEY,
+                 count INTEGER NOT NULL DEFAULT 0,
+                 volume INTEGER NOT NULL DEFAULT 0)''')
+    
+    # Первый запуск на существующей базе: один полный подсчет, дальше только триггеры
+    if c.execute("SELECT COUNT(*) FROM stats").fetchone()[0] == 0:
+        c.execute('''INSERT INTO stats (key, value)
+                    SELECT 'users', COUNT(*) FROM users
+                    UNION ALL SELECT 'money', COALESCE(SUM(balance), 0) FROM users
+                    UNION ALL SELECT 'dead_users', COALESCE(SUM(is_dead), 0) FROM users''')
+        c.execute('''INSERT OR REPLACE INTO transaction_stats (type, count, volume)
+                    SELECT COALESCE(type, ''), COUNT(*), COALESCE(SUM(amount), 0) FROM transactions GROUP BY type''')
+    
+    c.executescript('''
+        CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'users';
+            UPDATE stats SET value = value + COALESCE(NEW.balance, 0) WHERE key = 'money';
+            UPDATE stats SET value = value + COALESCE(NEW.is_dead, 0) WHERE key = 'dead_users';
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET value = value - 1 WHERE key = 'users';
+            UPDATE stats SET value = value - COALESCE(OLD.balance, 0) WHERE key = 'money';
+            UPDATE stats SET value = value - COALESCE(OLD.is_dead, 0) WHERE key = 'dead_users';
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_users_balance AFTER UPDATE OF balance ON users
+        WHEN NEW.balance IS NOT OLD.balance BEGIN
+            UPDATE stats SET value = value + COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0) WHERE key = 'money';
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_users_dead AFTER UPDATE OF is_dead ON users
+        WHEN NEW.is_dead IS NOT OLD.is_dead BEGIN
+            UPDATE stats SET value = value + COALESCE(NEW.is_dead, 0) - COALESCE(OLD.is_dead, 0) WHERE key = 'dead_users';
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_transactions_insert AFTER INSERT ON transactions BEGIN
+            INSERT INTO transaction_stats (type, count, volume) VALUES (COALESCE(NEW.type, ''), 1, COALESCE(NEW.amount, 0))
+            ON CONFLICT(type) DO UPDATE SET count = count + 1, volume = volume + excluded.volume;
+        END;
+    ''')
+
+def init_user_search(c):
+    # Полнотекстовый индекс по именам поверх users (external content), синхронизируется
+    # триггерами. Без FTS5 в сборке SQLite поиск работает через LIKE.
+    global user_search_fts
+    try:
+        exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'").fetchone()
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5
+                    (username, first_name, last_name, content='users', content_rowid='user_id',
+                     tokenize='unicode61 remove_diacritics 2')''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"⚠️ FTS5 недоступен, поиск пользователей через LIKE: {e}")
+        user_search_fts = False
+        return
+    
+    # unicode61 не приравнивает ё к е, поэтому в индекс попадают имена с заменой
+    def names(row):
+        return ', '.join(f"replace(replace({row}.{column}, 'ё', 'е'), 'Ё', 'Е')"
+                         for column in ('username', 'first_name', 'last_name'))
+    
+    c.executescript(f'''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username, first_name, last_name)
+            VALUES (NEW.user_id, {names('NEW')});
+        END;
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name)
+            VALUES ('delete', OLD.user_id, {names('OLD')});
+        END;
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name, last_name ON users
+        WHEN NEW.username IS NOT OLD.username OR NEW.first_name IS NOT OLD.first_name
+             OR NEW.last_name IS NOT OLD.last_name BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name)
+            VALUES ('delete', OLD.user_id, {names('OLD')});
+            INSERT INTO users_fts (rowid, username, first_name, last_name)
+            VALUES (NEW.user_id, {names('NEW')});
+        END;
+    ''')
+    if not exists:
+        c.execute(f"INSERT INTO users_fts (rowid, username, first_name, last_name) SELECT user_id, {names('users')} FROM users")
+    user_search_fts = True
 
 def init_db():
     global conn
     try:
-        conn = sqlite3.connect('casino_mega.db', check_same_thread=False, timeout=10)
+        # Единственное пишущее соединение, им пользуется только поток леджера
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
         c = conn.cursor()
+        c.execute("PRAGMA journal_mode = WAL")
+        c.execute("PRAGMA synchronous = NORMAL")
+        _tune_connection(conn)
         
         c.execute('''CREATE TABLE IF NOT EXISTS users
                     (user_id INTEGER PRIMARY KEY, 
@@ -46,6 +545,13 @@ def init_db():
                      last_bonus TEXT,
                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
         
+        # Статус доставки: last_seen — последнее входящее обновление,
+        # is_dead — чат недоступен (бот заблокирован, аккаунт удален)
+        _add_column(c, 'users', 'last_seen', 'TIMESTAMP')
+        _add_column(c, 'users', 'is_dead', 'INTEGER DEFAULT 0')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_live ON users(user_id) WHERE is_dead = 0")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance)")
+        
         c.execute('''CREATE TABLE IF NOT EXISTS transactions
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
                      from_user INTEGER,
@@ -54,112 +560,762 @@ def init_db():
                      type TEXT,
                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
         
+        c.execute('''CREATE TABLE IF NOT EXISTS broadcasts
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     admin_chat INTEGER,
+                     text TEXT,
+                     status TEXT DEFAULT 'running',
+                     last_user_id INTEGER DEFAULT 0,
+                     sent INTEGER DEFAULT 0,
+                     failed INTEGER DEFAULT 0,
+                     total INTEGER DEFAULT 0,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     finished_at TIMESTAMP)''')
+        
+        # Незавершенные игры со ставками: mines (id игры), roulette (id = 0),
+        # table (id чата); state — JSON состояния игры
+        c.execute('''CREATE TABLE IF NOT EXISTS game_state
+                    (kind TEXT NOT NULL,
+                     id INTEGER NOT NULL,
+                     user_id INTEGER NOT NULL,
+                     state TEXT NOT NULL,
+                     PRIMARY KEY (kind, id, user_id)) WITHOUT ROWID''')
+        
+        init_stats(c)
+        init_user_search(c)
+        
         conn.commit()
-        logger.info("✅ База данных инициализирована")
+        logger.info(f"✅ База данных инициализирована (журнал: {c.execute('PRAGMA journal_mode').fetchone()[0]})")
         
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
         raise
 
+# БЛОКИРОВКИ ПОЛЬЗОВАТЕЛЕЙ
+# Проверка баланса и списание, ходы в игре и ее закрытие по таймеру должны
+# идти по очереди для одного пользователя. Блокировка выбирается по user_id
+# из фиксированного набора, поэтому память не растет с числом игроков.
+user_locks = [threading.RLock() for _ in range(USER_LOCK_STRIPES)]
+
+class UserLock:
+    # Ожидание блокировки попадает в трассу обновления
+    __slots__ = ('lock',)
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        trace_span('lock', time.perf_counter() - start)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.lock.release()
+
+def user_lock(user_id):
+    return UserLock(user_locks[user_id % USER_LOCK_STRIPES])
+
+class LedgerRejected(Exception):
+    # Условие в БД не выполнено — операция леджера откачена целиком
+    pass
+
+class InsufficientFunds(LedgerRejected):
+    pass
+
+class BonusAlreadyClaimed(LedgerRejected):
+    pass
+
+class GameSettled(LedgerRejected):
+    # Строки игры в game_state уже нет: игру рассчитали раньше
+    pass
+
+# ЛЕДЖЕР (единственный писатель в БД)
+class LedgerOp:
+    __slots__ = ('fn', 'post', 'result', 'error', 'done')
+
+    def __init__(self, fn, post=None):
+        self.fn = fn
+        self.post = post
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+def _commit_batch(batch):
+    with db_lock:
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for op in batch:
+                # Каждая операция в своем savepoint: ошибка одной не откатывает остальные
+                c.execute("SAVEPOINT ledger_op")
+                start = time.perf_counter()
+                try:
+                    op.result = op.fn(c)
+                    c.execute("RELEASE ledger_op")
+                except Exception as e:
+                    c.execute("ROLLBACK TO ledger_op")
+                    c.execute("RELEASE ledger_op")
+                    op.error = e
+                ledger_op_seconds.observe(time.perf_counter() - start, op.fn.__qualname__)
+            start = time.perf_counter()
+            conn.commit()
+            ledger_commit_seconds.observe(time.perf_counter() - start)
+            ledger_batch_size.observe(len(batch))
+        except Exception as e:
+            logger.error(f"❌ Ошибка фиксации пакета ({len(batch)} оп.): {e}")
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            for op in batch:
+                op.result = None
+                op.error = op.error or e
+        else:
+            _after_commit(batch)
+    for op in batch:
+        op.done.set()
+
+def _after_commit(batch):
+    # Кэш обновляется строго после COMMIT и в порядке операций в пакете
+    global user_cache_gen
+    with user_cache_lock:
+        user_cache_gen += 1
+        for op in batch:
+            if op.post and op.error is None:
+                try:
+                    op.post(op.result)
+                except Exception as e:
+                    logger.error(f"Ошибка обновления кэша: {e}")
+
+def _ledger_writer():
+    while True:
+        batch = [ledger_queue.get()]
+        deadline = time.monotonic() + LEDGER_COMMIT_WINDOW
+        while len(batch) < LEDGER_BATCH_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(ledger_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        _commit_batch(batch)
+
+def start_ledger():
+    threading.Thread(target=_ledger_writer, name="ledger-writer", daemon=True).start()
+
+def db_write(fn, post=None):
+    op = LedgerOp(fn, post)
+    start = time.perf_counter()
+    ledger_queue.put(op)
+    op.done.wait()
+    elapsed = time.perf_counter() - start
+    ledger_wait_seconds.observe(elapsed)
+    trace_span('db', elapsed)
+    if op.error:
+        raise op.error
+    return op.result
+
+def _insert_transaction(c, transaction):
+    c.execute("INSERT INTO transactions (from_user, to_user, amount, type) VALUES (?, ?, ?, ?)",
+             transaction)
+
+def ledger_apply(deltas, transaction=None, extra=None, post=None):
+    # deltas: [(user_id, сумма)], transaction: (from_user, to_user, amount, type).
+    # Все изменения и запись в transactions попадают в БД атомарно. Списание
+    # условное: если денег не хватает, операция откатывается целиком
+    # и вызывающий получает InsufficientFunds.
+    def op(c):
+        balances = {}
+        for user_id, amount in deltas:
+            amount = int(amount)
+            if amount < 0:
+                c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ? AND balance >= ? RETURNING balance",
+                         (amount, user_id, -amount))
+                row = c.fetchone()
+                if row is None:
+                    raise InsufficientFunds(user_id)
+            else:
+                c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance",
+                         (amount, user_id))
+                row = c.fetchone()
+            balances[user_id] = row[0] if row else 0
+        if transaction:
+            _insert_transaction(c, transaction)
+        if extra:
+            extra(c)
+        return balances
+
+    def after_commit(balances):
+        for user_id, balance in balances.items():
+            _cache_set(user_id, balance=balance)
+        if post:
+            post()
+
+    try:
+        return db_write(op, after_commit)
+    except LedgerRejected:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка леджера {deltas}: {e}")
+        return None
+
+def get_read_conn():
+    read_conn = getattr(read_local, 'conn', None)
+    if read_conn is None:
+        read_conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
+        read_conn.execute("PRAGMA query_only = ON")
+        _tune_connection(read_conn)
+        read_local.conn = read_conn
+        with read_conns_lock:
+            read_conns.append(read_conn)
+    return read_conn
+
+def db_read(query, params=(), one=True):
+    # В WAL читатели не блокируют писателя и видят последний COMMIT
+    start = time.perf_counter()
+    c = get_read_conn().cursor()
+    c.execute(query, params)
+    result = c.fetchone() if one else c.fetchall()
+    elapsed = time.perf_counter() - start
+    db_query_seconds.observe(elapsed, _query_label(query))
+    trace_span('db', elapsed)
+    return result
+
+def _cache_set(user_id, **fields):
+    # Вызывается под user_cache_lock из потока леджера
+    if 'balance' in fields or 'username' in fields:
+        leaderboard_note(user_id, fields.get('balance'))
+    row = user_cache.get(user_id)
+    if row is not None:
+        for field, value in fields.items():
+            row[USER_FIELDS[field]] = value
+
+def get_user_row(user_id):
+    with user_cache_lock:
+        row = user_cache.get(user_id)
+        if row is not None:
+            user_cache.move_to_end(user_id)
+            user_cache_stats['hits'] += 1
+            return tuple(row)
+        user_cache_stats['misses'] += 1
+        gen = user_cache_gen
+    
+    row = db_read("SELECT * FROM users WHERE user_id = ?", (user_id,))
+    if row:
+        with user_cache_lock:
+            # Если между чтением и вставкой был COMMIT, строка могла устареть
+            if gen == user_cache_gen:
+                _cache_fill(user_id, row)
+    return row
+
+def _cache_fill(user_id, row):
+    # Вызывается под user_cache_lock
+    if user_id not in user_cache:
+        user_cache[user_id] = list(row)
+        if len(user_cache) > USER_CACHE_SIZE:
+            user_cache.popitem(last=False)
+
+def get_user_cache_stats():
+    with user_cache_lock:
+        hits = user_cache_stats['hits']
+        misses = user_cache_stats['misses']
+        size = len(user_cache)
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'size': size,
+            'hit_rate': hits / total if total else 0.0}
+
 def get_user(user_id):
     try:
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = c.fetchone()
+        user = get_user_row(user_id)
         
         if not user:
-            c.execute("INSERT INTO users (user_id, balance) VALUES (?, ?)", (user_id, 0))
-            conn.commit()
-            c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            user = c.fetchone()
+            # Вставка или чтение уже существующей строки — одна операция в леджере
+            def op(c):
+                c.execute("INSERT INTO users (user_id, balance) VALUES (?, 0) "
+                          "ON CONFLICT(user_id) DO NOTHING RETURNING *", (user_id,))
+                row = c.fetchone()
+                if row is None:
+                    c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+                    row = c.fetchone()
+                return row
+
+            def post(row):
+                # Строка прочитана до COMMIT, более поздние операции пакета
+                # обновят ее в кэше своими post
+                _cache_fill(user_id, row)
+                leaderboard_note(user_id, row[1])
+
+            user = db_write(op, post)
         
         return user
     except sqlite3.Error as e:
         logger.error(f"Ошибка get_user для {user_id}: {e}")
-        init_db()
         return None
 
 def update_user_info(user_id, username, first_name, last_name):
+    # Пишем только изменившийся профиль, и не сразу: запись сбрасывается
+    # пачкой вместе со статусом доставки
     try:
-        c = conn.cursor()
-        c.execute("UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?",
-                 (username, first_name, last_name, user_id))
-        conn.commit()
+        profile = (username, first_name, last_name)
+        row = get_user_row(user_id)
+        if row and tuple(row[2:5]) == profile:
+            return True
+        with delivery_lock:
+            profile_pending[user_id] = profile
         return True
     except:
         return False
 
-def update_balance(user_id, amount):
-    try:
-        c = conn.cursor()
-        c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (int(amount), user_id))
-        conn.commit()
-        return get_user_balance(user_id)
-    except:
-        conn.rollback()
-        return 0
+def update_balance(user_id, amount, transaction=None):
+    balances = ledger_apply([(user_id, amount)], transaction)
+    return balances[user_id] if balances else 0
+
+def transfer(from_user, to_user, amount, trans_type):
+    # Списание, зачисление и запись о переводе — одна транзакция
+    return ledger_apply([(from_user, -amount), (to_user, amount)], (from_user, to_user, amount, trans_type))
 
 def get_user_balance(user_id):
     try:
-        c = conn.cursor()
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-        return result[0] if result else 0
+        result = get_user_row(user_id)
+        return result[1] if result else 0
     except:
         return 0
 
-def set_user_balance(user_id, amount):
-    try:
-        c = conn.cursor()
+def set_user_balance(user_id, amount, trans_type=None):
+    # Возвращает старый баланс или None
+    def op(c):
+        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        row = c.fetchone()
+        if not row:
+            return None
         c.execute("UPDATE users SET balance = ? WHERE user_id = ?", (int(amount), user_id))
-        conn.commit()
-        return True
+        if trans_type:
+            _insert_transaction(c, (0, user_id, int(amount) - row[0], trans_type))
+        return row[0]
+
+    try:
+        return db_write(op, lambda old: old is not None and _cache_set(user_id, balance=int(amount)))
     except:
-        return False
+        return None
 
 def add_transaction(from_user, to_user, amount, trans_type):
     try:
-        c = conn.cursor()
-        c.execute("INSERT INTO transactions (from_user, to_user, amount, type) VALUES (?, ?, ?, ?)",
-                 (from_user, to_user, amount, trans_type))
-        conn.commit()
+        db_write(lambda c: _insert_transaction(c, (from_user, to_user, amount, trans_type)))
         return True
     except:
         return False
 
+def _set_last_bonus(c, user_id, current_time):
+    c.execute("UPDATE users SET last_bonus = ? WHERE user_id = ?", (current_time, user_id))
+
 def update_last_bonus(user_id):
+    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     try:
-        c = conn.cursor()
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        c.execute("UPDATE users SET last_bonus = ? WHERE user_id = ?", (current_time, user_id))
-        conn.commit()
+        db_write(lambda c: _set_last_bonus(c, user_id, current_time),
+                 lambda _: _cache_set(user_id, last_bonus=current_time))
         return True
     except:
         return False
 
+def _claim_bonus(c, user_id, current_time, cutoff):
+    # Условие в самом UPDATE: из двух одновременных запросов бонус получит один,
+    # второй откатит начисление вместе со своей операцией
+    c.execute("UPDATE users SET last_bonus = ? WHERE user_id = ? AND (last_bonus IS NULL OR last_bonus <= ?)",
+              (current_time, user_id, cutoff))
+    if c.rowcount == 0:
+        raise BonusAlreadyClaimed(user_id)
+
+def credit_daily_bonus(user_id):
+    now = datetime.now()
+    current_time = now.strftime('%Y-%m-%d %H:%M:%S')
+    cutoff = (now - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
+    balances = ledger_apply([(user_id, DAILY_BONUS)], (0, user_id, DAILY_BONUS, "daily_bonus"),
+                            extra=lambda c: _claim_bonus(c, user_id, current_time, cutoff),
+                            post=lambda: _cache_set(user_id, last_bonus=current_time))
+    return balances[user_id] if balances else 0
+
 def get_last_bonus(user_id):
     try:
-        c = conn.cursor()
-        c.execute("SELECT last_bonus FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone()
-        return result[0] if result else None
+        result = get_user_row(user_id)
+        return result[5] if result else None
     except:
         return None
 
+# ЛИДЕРБОРД
+# Топ читается по индексу idx_users_balance и кэшируется. После COMMIT кэш
+# сбрасывается, только если изменение может его задеть: изменился игрок из
+# топа или его новый баланс не ниже последнего места.
+# Место любого игрока считается без запроса к БД: балансы всех игроков лежат
+# отсортированным массивом, место — 1 + число балансов больше своего (bisect).
+# Массив загружается при старте и обновляется теми же уведомлениями после COMMIT.
+leaderboard_rows = None
+leaderboard_ids = frozenset()
+leaderboard_gen = 0
+leaderboard_lock = threading.Lock()
+rank_balances = array('q')
+rank_by_user = {}
+
+def load_balance_ranks():
+    rows = db_read("SELECT user_id, balance FROM users ORDER BY balance", one=False)
+    with leaderboard_lock:
+        rank_by_user.clear()
+        rank_by_user.update(rows)
+        rank_balances[:] = array('q', (balance for _, balance in rows))
+
+def _rank_update(user_id, balance):
+    # Вызывается под leaderboard_lock
+    old = rank_by_user.get(user_id)
+    if old == balance:
+        return
+    if old is not None:
+        del rank_balances[bisect.bisect_left(rank_balances, old)]
+    bisect.insort(rank_balances, balance)
+    rank_by_user[user_id] = balance
+
+def leaderboard_note(user_id, balance=None):
+    global leaderboard_rows, leaderboard_gen
+    with leaderboard_lock:
+        if balance is not None:
+            _rank_update(user_id, balance)
+        rows = leaderboard_rows
+        if rows is not None and user_id not in leaderboard_ids:
+            if balance is None or (len(rows) == LEADERBOARD_SIZE and balance < rows[-1][1]):
+                return
+        leaderboard_rows = None
+        leaderboard_gen += 1
+
+def get_leaderboard():
+    # [(user_id, balance, username, first_name)] по убыванию баланса
+    global leaderboard_rows, leaderboard_ids
+    with leaderboard_lock:
+        if leaderboard_rows is not None:
+            return leaderboard_rows
+        gen = leaderboard_gen
+    
+    rows = db_read("SELECT user_id, balance, username, first_name FROM users ORDER BY balance DESC LIMIT ?",
+                   (LEADERBOARD_SIZE,), one=False)
+    with leaderboard_lock:
+        # Если между чтением и сохранением был COMMIT, результат мог устареть
+        if gen == leaderboard_gen:
+            leaderboard_rows = rows
+            leaderboard_ids = frozenset(row[0] for row in rows)
+    return rows
+
+def get_user_rank(user_id):
+    # Место = 1 + число игроков с большим балансом
+    for place, row in enumerate(get_leaderboard(), 1):
+        if row[0] == user_id:
+            return place
+    with leaderboard_lock:
+        balance = rank_by_user.get(user_id)
+        if balance is None:
+            return None
+        return len(rank_balances) - bisect.bisect_right(rank_balances, balance) + 1
+
+# ПОИСК ПОЛЬЗОВАТЕЛЕЙ
+user_search_fts = False
+
+def _fts_query(text):
+    # Каждое слово — префиксный запрос, все слова обязательны
+    words = [word.lstrip('@') for word in text.replace('ё', 'е').replace('Ё', 'Е').split()]
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in words if word)
+
+def find_users(text, offset=0, limit=FINDUSER_PAGE):
+    # Возвращает до limit + 1 строк, лишняя означает, что есть следующая страница
+    columns = "u.user_id, u.balance, u.username, u.first_name, u.last_name"
+    text = text.strip()
+    if text.isdigit():
+        rows = db_read(f"SELECT {columns} FROM users u WHERE u.user_id = ?", (int(text),), one=False)
+        if rows:
+            return rows if offset == 0 else []
+    
+    query = _fts_query(text)
+    if not query:
+        return []
+    if user_search_fts:
+        try:
+            return db_read(f'''SELECT {columns} FROM users_fts JOIN users u ON u.user_id = users_fts.rowid
+                              WHERE users_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?''',
+                           (query, limit + 1, offset), one=False)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Ошибка FTS-поиска '{text}': {e}")
+    
+    pattern = '%' + text.lstrip('@') + '%'
+    return db_read(f'''SELECT {columns} FROM users u
+                      WHERE u.username LIKE ? OR u.first_name LIKE ? OR u.last_name LIKE ?
+                      ORDER BY u.user_id LIMIT ? OFFSET ?''',
+                   (pattern, pattern, pattern, limit + 1, offset), one=False)
+
+# СТАТУС ДОСТАВКИ
+delivery_pending = {}
+profile_pending = {}
+delivery_lock = threading.Lock()
+
+def mark_seen(user_id):
+    with delivery_lock:
+        delivery_pending[user_id] = True
+
+def mark_dead(user_id):
+    with delivery_lock:
+        delivery_pending[user_id] = False
+
+def is_dead_chat_error(error):
+    # 403 — бот заблокирован или аккаунт удален, 400 — чат не найден
+    if getattr(error, 'error_code', None) not in (400, 403):
+        return False
+    description = (getattr(error, 'description', None) or '').lower()
+    return any(reason in description for reason in DEAD_CHAT_ERRORS)
+
+def flush_delivery_status():
+    with delivery_lock:
+        if not delivery_pending:
+            return
+        pending = dict(delivery_pending)
+        delivery_pending.clear()
+    
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    alive = [(now, user_id) for user_id, is_alive in pending.items() if is_alive]
+    dead = [(user_id,) for user_id, is_alive in pending.items() if not is_alive]
+    
+    def op(c):
+        if alive:
+            c.executemany("UPDATE users SET last_seen = ?, is_dead = 0 WHERE user_id = ?", alive)
+        if dead:
+            c.executemany("UPDATE users SET is_dead = 1 WHERE user_id = ?", dead)
+    
+    try:
+        db_write(op)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения статуса доставки: {e}")
+
+def flush_profiles():
+    with delivery_lock:
+        if not profile_pending:
+            return
+        pending = dict(profile_pending)
+        profile_pending.clear()
+    
+    def post(_):
+        for user_id, (username, first_name, last_name) in pending.items():
+            _cache_set(user_id, username=username, first_name=first_name, last_name=last_name)
+    
+    try:
+        db_write(lambda c: c.executemany("UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?",
+                                         [profile + (user_id,) for user_id, profile in pending.items()]),
+                 post)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения профилей: {e}")
+
+def _delivery_flusher():
+    while True:
+        time.sleep(DELIVERY_FLUSH_INTERVAL)
+        flush_delivery_status()
+        flush_profiles()
+
+def start_delivery_flusher():
+    threading.Thread(target=_delivery_flusher, name="delivery-flusher", daemon=True).start()
+
+def get_stats():
+    return dict(db_read("SELECT key, value FROM stats", one=False))
+
+def get_transaction_stats():
+    return db_read("SELECT type, count, volume FROM transaction_stats ORDER BY volume DESC", one=False)
+
+def get_live_user_counts():
+    stats = get_stats()
+    return stats['users'] - stats['dead_users'], stats['dead_users']
+
+def format_uptime(seconds):
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{days}д {hours:02d}:{minutes:02d}:{seconds:02d}" if days else f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+# ПЛАНИРОВЩИК
+# Отложенные задачи лежат в куче по времени срабатывания, один поток спит до ближайшей.
+# С workers задачи выполняются в пуле: задача, ждущая блокировку пользователя
+# (закрытие игры по таймеру), не задерживает остальные
+class Scheduler:
+    def __init__(self, name="scheduler", workers=0):
+        self.name = name
+        self.workers = workers
+        self.executor = None
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def schedule(self, delay, fn, *args):
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), fn, args))
+            self.cond.notify()
+
+    def pending(self):
+        return len(self.heap)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                deadline, seq, fn, args = heapq.heappop(self.heap)
+            if self.executor is None:
+                self._call(fn, args)
+                continue
+            try:
+                self.executor.submit(self._call, fn, args)
+            except RuntimeError:
+                # Пул закрыт при выходе интерпретатора
+                return
+
+    def _call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"Ошибка отложенной задачи {fn.__name__}: {e}")
+
+    def start(self):
+        if self.workers:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        threading.Thread(target=self.run, name=self.name, daemon=True).start()
+
+scheduler = Scheduler(workers=SCHEDULER_WORKERS)
+
 def close_db():
     global conn
-    if conn:
-        conn.close()
-        logger.info("Соединение с БД закрыто")
+    with read_conns_lock:
+        for read_conn in read_conns:
+            try:
+                read_conn.close()
+            except sqlite3.Error:
+                pass
+        read_conns.clear()
+    with db_lock:
+        if conn:
+            conn.close()
+            logger.info("Соединение с БД закрыто")
 
 atexit.register(close_db)
+atexit.register(flush_delivery_status)
+atexit.register(flush_profiles)
 init_db()
+load_balance_ranks()
+start_ledger()
+start_delivery_flusher()
+scheduler.start()
 
 mines_games = {}
 roulette_bets = {}
 roulette_timers = {}
 user_last_bonus_check = {}
 
+# КЭШ TELEGRAM (get_me, get_chat)
+class TTLCache:
+    # LRU с временем жизни записей; ошибки загрузки тоже кэшируются (на negative_ttl)
+    def __init__(self, maxsize, ttl, negative_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.data.get(key)
+            if entry and entry[0] > now:
+                self.data.move_to_end(key)
+                self.hits += 1
+                if entry[2]:
+                    raise entry[2]
+                return entry[1]
+            self.misses += 1
+        
+        try:
+            value = loader(key)
+        except Exception as e:
+            self._store(key, (now + self.negative_ttl, None, e))
+            raise
+        self._store(key, (now + self.ttl, value, None))
+        return value
+
+    def _store(self, key, entry):
+        with self.lock:
+            self.data[key] = entry
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+bot_identity = None
+chat_cache = TTLCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL, CHAT_NEGATIVE_TTL)
+
+def get_bot_identity():
+    # Личность бота не меняется — запрашиваем один раз за процесс
+    global bot_identity
+    if bot_identity is None:
+        bot_identity = bot.get_me()
+    return bot_identity
+
+def get_chat_cached(chat_id):
+    return chat_cache.get_or_load(chat_id, bot.get_chat)
+
+# ДИСПЕТЧЕР ТЕКСТОВЫХ КОМАНД
+# Текст нормализуется один раз, команда ищется в словаре: точное совпадение
+# или первое слово (команды с аргументами). Остальное — ставки в рулетку,
+# если сообщение начинается с числа; прочий шум отбрасывается без обращения к БД.
+text_commands = {}
+prefix_commands = {}
+
+def text_command(*names, prefix=False):
+    def decorator(handler):
+        table = prefix_commands if prefix else text_commands
+        for name in names:
+            table[name] = handler
+        return handler
+    return decorator
+
+def resolve_text_command(text):
+    normalized = text.strip().lower()
+    handler = text_commands.get(normalized)
+    if handler:
+        return handler
+    
+    parts = normalized.split(maxsplit=1)
+    if len(parts) < 2:
+        return None
+    handler = prefix_commands.get(parts[0])
+    if handler:
+        return handler
+    if parts[0].lstrip('+-').isdigit():
+        return place_roulette_bets
+    return None
+
+@bot.middleware_handler()
+def track_last_seen(bot_instance, update):
+    # Время получения для трассировки: вебхук ставит его сам при разборе
+    event = update.message or update.callback_query
+    if event:
+        event.received_at = getattr(update, 'received_at', None) or time.perf_counter()
+        event.parse_seconds = getattr(update, 'parse_seconds', 0.0)
+    
+    if update.message and update.message.from_user:
+        mark_seen(update.message.from_user.id)
+    elif update.callback_query:
+        mark_seen(update.callback_query.from_user.id)
+
+@bot.my_chat_member_handler()
+def chat_member_changed(update):
+    # Telegram сам сообщает, когда пользователь блокирует или разблокирует бота
+    if update.chat.type != 'private':
+        return
+    if update.new_chat_member.status == 'kicked':
+        mark_dead(update.chat.id)
+    elif update.new_chat_member.status == 'member':
+        mark_seen(update.chat.id)
+
 # АДМИН КОМАНДЫ
 @bot.message_handler(commands=['start'])
 def start_command(message):
@@ -173,6 +1329,7 @@ def start_command(message):
 `бонус` - получить бонус
 `п [сумма]` - перевод (ответом на сообщение)
 `п [ID] [сумма]` - перевод по ID
+`топ` - топ игроков и ваше место
 
 🎮 *Игры:*
 `мины [сумма]` - игра в мины
@@ -208,11 +1365,14 @@ def admin_help(message):
 `/addadmin [ID]` - добавить админа
 `/deladmin [ID]` - удалить админа
 `/broadcast [текст]` - рассылка всем
+`/bstatus` - прогресс рассылки
+`/bcancel` - отменить рассылку
 `/status` - статус бота
 `/admin` - список админов
 `/allusers` - все пользователи
 `/top20` - топ 20 по балансу
 `/finduser [ID/имя]` - найти пользователя
+`/profile [сек]` - снять профиль (flamegraph)
 """
     bot.reply_to(message, help_text, parse_mode='Markdown')
 
@@ -241,8 +1401,7 @@ def give_balance(message):
             bot.reply_to(message, f"❌ Пользователь `{target_id}` не найден")
             return
         
-        new_balance = update_balance(target_id, amount)
-        add_transaction(0, target_id, amount, "admin_give")
+        new_balance = update_balance(target_id, amount, (0, target_id, amount, "admin_give"))
         
         bot.reply_to(message, f"""
 ✅ *Баланс выдан*
@@ -284,8 +1443,11 @@ def take_balance(message):
             bot.reply_to(message, f"❌ У пользователя недостаточно средств!\nБаланс: {target_balance} GRAM")
             return
         
-        new_balance = update_balance(target_id, -amount)
-        add_transaction(target_id, 0, amount, "admin_take")
+        try:
+            new_balance = update_balance(target_id, -amount, (target_id, 0, amount, "admin_take"))
+        except InsufficientFunds:
+            bot.reply_to(message, "❌ У пользователя недостаточно средств!")
+            return
         
         bot.reply_to(message, f"""
 ✅ *Баланс изъят*
@@ -322,9 +1484,10 @@ def set_balance(message):
             bot.reply_to(message, f"❌ Пользователь `{target_id}` не найден")
             return
         
-        old_balance = get_user_balance(target_id)
-        set_user_balance(target_id, amount)
-        add_transaction(0, target_id, amount - old_balance, "admin_set")
+        old_balance = set_user_balance(target_id, amount, "admin_set")
+        if old_balance is None:
+            bot.reply_to(message, "❌ Не удалось установить баланс")
+            return
         
         bot.reply_to(message, f"""
 ✅ *Баланс установлен*
@@ -403,6 +1566,114 @@ def del_admin(message):
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
 
+# РАССЫЛКА
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # После 429 Telegram просит подождать retry_after секунд — ждут все отправители
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+broadcast_jobs = {}
+broadcast_jobs_lock = threading.Lock()
+
+def get_retry_after(error):
+    # Исключения sync и async клиентов — разные классы, но с одинаковыми полями
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+def _broadcast_send(user_id, text, cancel_event):
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        if cancel_event.is_set():
+            return None
+        broadcast_bucket.acquire()
+        try:
+            sent_result(bot.send_message(user_id, f"📢 *РАССЫЛКА ОТ АДМИНИСТРАЦИИ:*\n\n{text}", parse_mode='Markdown'))
+            return True
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None:
+                if is_dead_chat_error(e):
+                    mark_dead(user_id)
+                return False
+            logger.warning(f"Рассылка: 429, пауза {retry_after} сек.")
+            broadcast_bucket.pause(retry_after)
+    return False
+
+def _run_broadcast(job_id, cancel_event):
+    row = db_read("SELECT admin_chat, text, last_user_id, sent, failed, total FROM broadcasts WHERE id = ?", (job_id,))
+    admin_chat, text, cursor, sent, failed, total = row
+    
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix=f"broadcast-{job_id}") as pool:
+        while not cancel_event.is_set():
+            chunk = db_read("SELECT user_id FROM users WHERE is_dead = 0 AND user_id > ? ORDER BY user_id LIMIT ?",
+                            (cursor, BROADCAST_CHUNK), one=False)
+            if not chunk:
+                break
+            
+            results = list(pool.map(lambda user: _broadcast_send(user[0], text, cancel_event), chunk))
+            sent += results.count(True)
+            failed += results.count(False)
+            # При отмене курсор не уходит дальше первого неотправленного получателя
+            for user, result in zip(chunk, results):
+                if result is None:
+                    break
+                cursor = user[0]
+            # Прогресс сохраняется после каждой пачки, после рестарта продолжим с нее
+            db_write(lambda c: c.execute("UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ? WHERE id = ?",
+                                         (cursor, sent, failed, job_id)))
+    
+    status = 'cancelled' if cancel_event.is_set() else 'done'
+    db_write(lambda c: c.execute("UPDATE broadcasts SET status = ?, sent = ?, failed = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                                 (status, sent, failed, job_id)))
+    with broadcast_jobs_lock:
+        broadcast_jobs.pop(job_id, None)
+    
+    title = "✅ *Рассылка завершена*" if status == 'done' else "⛔ *Рассылка отменена*"
+    bot.send_message(admin_chat, f"""
+{title} (#{job_id})
+👥 Всего получателей: {total}
+✅ Успешно: {sent}
+❌ Не удалось: {failed}
+""", parse_mode='Markdown')
+
+def start_broadcast_job(job_id):
+    cancel_event = threading.Event()
+    with broadcast_jobs_lock:
+        broadcast_jobs[job_id] = cancel_event
+    threading.Thread(target=_run_broadcast, args=(job_id, cancel_event), name=f"broadcast-{job_id}", daemon=True).start()
+
+def resume_broadcasts():
+    for row in db_read("SELECT id FROM broadcasts WHERE status = 'running'", one=False):
+        logger.info(f"📢 Продолжаем рассылку #{row[0]}")
+        start_broadcast_job(row[0])
+
 @bot.message_handler(commands=['broadcast'])
 def broadcast_message(message):
     user_id = message.from_user.id
@@ -416,35 +1687,71 @@ def broadcast_message(message):
             bot.reply_to(message, "❌ Формат: `/broadcast [текст]`")
             return
         
-        # Получаем всех пользователей
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM users")
-        all_users = c.fetchall()
+        with broadcast_jobs_lock:
+            if broadcast_jobs:
+                bot.reply_to(message, f"❌ Уже идет рассылка #{next(iter(broadcast_jobs))}\n`/bstatus` - прогресс, `/bcancel` - отменить")
+                return
         
-        total_users = len(all_users)
-        successful = 0
-        failed = 0
+        total_users, dead_users = get_live_user_counts()
+        job_id = db_write(lambda c: c.execute("INSERT INTO broadcasts (admin_chat, text, total) VALUES (?, ?, ?)",
+                                              (message.chat.id, text, total_users)).lastrowid)
+        start_broadcast_job(job_id)
         
-        bot.reply_to(message, f"📢 Рассылка начата...\nПолучателей: {total_users}")
+        bot.reply_to(message, f"📢 Рассылка #{job_id} начата...\nПолучателей: {total_users} (пропущено недоступных: {dead_users})\n\n`/bstatus` - прогресс\n`/bcancel` - отменить")
         
-        for user in all_users:
-            try:
-                bot.send_message(user[0], f"📢 *РАССЫЛКА ОТ АДМИНИСТРАЦИИ:*\n\n{text}", parse_mode='Markdown')
-                successful += 1
-                time.sleep(0.05)  # Задержка чтобы не спамить
-            except:
-                failed += 1
+    except Exception as e:
+        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
+
+@bot.message_handler(commands=['bstatus'])
+def broadcast_status(message):
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        bot.reply_to(message, "❌ Эта команда только для админов")
+        return
+    
+    try:
+        row = db_read("SELECT id, status, sent, failed, total, created_at FROM broadcasts ORDER BY id DESC LIMIT 1")
+        if not row:
+            bot.reply_to(message, "📭 Рассылок еще не было")
+            return
+        
+        job_id, status, sent, failed, total, created_at = row
+        statuses = {'running': "⏳ идет", 'done': "✅ завершена", 'cancelled': "⛔ отменена"}
+        done = sent + failed
+        percent = done * 100 // total if total else 100
         
         bot.reply_to(message, f"""
-✅ *Рассылка завершена*
-👥 Всего получателей: {total_users}
-✅ Успешно: {successful}
+📢 *РАССЫЛКА #{job_id}*
+
+📌 Статус: {statuses.get(status, status)}
+📈 Прогресс: {done}/{total} ({percent}%)
+✅ Успешно: {sent}
 ❌ Не удалось: {failed}
+🕐 Начата: {created_at}
 """, parse_mode='Markdown')
         
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
 
+@bot.message_handler(commands=['bcancel'])
+def broadcast_cancel(message):
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        bot.reply_to(message, "❌ Эта команда только для админов")
+        return
+    
+    with broadcast_jobs_lock:
+        jobs = list(broadcast_jobs.items())
+    
+    if not jobs:
+        bot.reply_to(message, "📭 Нет активной рассылки")
+        return
+    
+    for job_id, cancel_event in jobs:
+        cancel_event.set()
+    
+    bot.reply_to(message, f"⛔ Рассылка #{jobs[0][0]} останавливается...")
+
 @bot.message_handler(commands=['status'])
 def bot_status(message):
     user_id = message.from_user.id
@@ -453,21 +1760,24 @@ def bot_status(message):
         return
     
     try:
-        c = conn.cursor()
-        
-        # Количество пользователей
-        c.execute("SELECT COUNT(*) FROM users")
-        total_users = c.fetchone()[0]
-        
-        # Общий баланс
-        c.execute("SELECT SUM(balance) FROM users")
-        total_balance = c.fetchone()[0] or 0
+        # Пользователи и общий баланс поддерживаются триггерами
+        stats = get_stats()
+        total_users = stats['users']
+        total_balance = stats['money']
         
         # Активные игры в мины
-        active_mines = len(mines_games)
+        active_mines = count_active_mines()
         
         # Активные ставки в рулетке
-        active_roulette = sum(len(bets) for bets in roulette_bets.values())
+        active_roulette = count_active_roulette_bets()
+        active_tables = len(roulette_tables)
+        
+        cache_stats = get_user_cache_stats()
+        expired_mines = expiry_stats['mines_cashout'] + expiry_stats['mines_forfeit']
+        evicted = expiry_stats['roulette_timers'] + expiry_stats['bonus_flags']
+        
+        volume_text = "".join(f"  • `{trans_type or '—'}`: {count} шт., {volume} GRAM\n"
+                              for trans_type, count, volume in get_transaction_stats())
         
         status_text = f"""
 📊 *СТАТУС БОТА*
@@ -476,9 +1786,17 @@ def bot_status(message):
 💰 Общий баланс: {total_balance} GRAM
 🎮 Активных игр в мины: {active_mines}
 🎰 Активных ставок в рулетке: {active_roulette}
+🎡 Столов рулетки: {active_tables}
+⌛ Истекло игр в мины: {expired_mines} (выплачено {expiry_stats['mines_cashout']}, сгорело {expiry_stats['mines_forfeit']})
+🧹 Очищено записей: {evicted} (кулдауны {expiry_stats['roulette_timers']}, бонусы {expiry_stats['bonus_flags']}), в планировщике {scheduler.pending()}
+📤 Исходящая очередь: {outbox.pending()} в {len(outbox.chats)} чатах
 👑 Админов: {len(ADMINS)}
-🔄 Перезапущен: {datetime.now().strftime('%H:%M:%S')}
-"""
+🗂 Кэш пользователей: {cache_stats['size']} (попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, {cache_stats['hit_rate']:.0%})
+🔄 Запущен: {datetime.fromtimestamp(START_TIME).strftime('%d.%m %H:%M:%S')}
+⏱ Аптайм: {format_uptime(time.time() - START_TIME)}
+
+💸 Обороты по типам:
+{volume_text or '  нет операций'}"""
         bot.reply_to(message, status_text, parse_mode='Markdown')
         
     except Exception as e:
@@ -511,11 +1829,11 @@ def all_users(message):
         return
     
     try:
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users")
-        total = c.fetchone()[0]
+        live, dead = get_live_user_counts()
         
-        bot.reply_to(message, f"👥 Всего пользователей: *{total}*", parse_mode='Markdown')
+        bot.reply_to(message, f"""👥 Всего пользователей: *{live + dead}*
+✅ Доступны: *{live}*
+🚫 Недоступны (заблокировали бота): *{dead}*""", parse_mode='Markdown')
         
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
@@ -528,9 +1846,7 @@ def top_20(message):
         return
     
     try:
-        c = conn.cursor()
-        c.execute("SELECT user_id, balance, username, first_name FROM users ORDER BY balance DESC LIMIT 20")
-        top_users = c.fetchall()
+        top_users = get_leaderboard()
         
         top_text = "🏆 *ТОП 20 ПО БАЛАНСУ:*\n\n"
         for i, user in enumerate(top_users, 1):
@@ -538,14 +1854,164 @@ def top_20(message):
             balance = user[1]
             username = user[2] or user[3] or f"ID: {user_id}"
             
-            top_text += f"{i}. {username} — *{balance}* GRAM\n"
+            top_text += f"{i}. `{username.replace('`', '')}` — *{balance}* GRAM\n"
         
         bot.reply_to(message, top_text, parse_mode='Markdown')
         
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
 
+# Запросы поиска хранятся на сервере: в callback_data помещается только номер
+finduser_queries = OrderedDict()
+finduser_ids = itertools.count(1)
+finduser_lock = threading.Lock()
+
+def render_finduser_page(search_id, text, offset):
+    rows = find_users(text, offset)
+    if not rows:
+        return "🔍 Ничего не найдено", None
+    
+    has_next = len(rows) > FINDUSER_PAGE
+    result_text = f"🔍 *ПОИСК:* `{text.replace('`', '')}`\n\n"
+    for i, user in enumerate(rows[:FINDUSER_PAGE], offset + 1):
+        user_id, balance, username, first_name, last_name = user
+        name = ' '.join(part for part in (first_name, last_name) if part).replace('`', '') or '—'
+        result_text += f"{i}. `{name}`"
+        if username:
+            result_text += f" (`@{username}`)"
+        result_text += f"\n    ID: `{user_id}` — *{balance}* GRAM\n"
+    
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"finduser_{search_id}_{max(0, offset - FINDUSER_PAGE)}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"finduser_{search_id}_{offset + FINDUSER_PAGE}"))
+    return result_text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@bot.message_handler(commands=['finduser'])
+def find_user_command(message):
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        bot.reply_to(message, "❌ Эта команда только для админов")
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    if len(parts) != 2 or not parts[1].strip():
+        bot.reply_to(message, "❌ Формат: `/finduser [ID/имя]`", parse_mode='Markdown')
+        return
+    
+    text = parts[1].strip()
+    with finduser_lock:
+        search_id = next(finduser_ids)
+        finduser_queries[search_id] = text
+        if len(finduser_queries) > FINDUSER_SESSIONS:
+            finduser_queries.popitem(last=False)
+    
+    try:
+        result_text, markup = render_finduser_page(search_id, text, 0)
+        bot.reply_to(message, result_text, parse_mode='Markdown', reply_markup=markup)
+    except Exception as e:
+        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
+
+def finduser_callback(call):
+    if call.from_user.id not in ADMINS:
+        bot.answer_callback_query(call.id, "❌ Только для админов")
+        return
+    
+    try:
+        prefix, search_id, offset = call.data.split('_')
+        with finduser_lock:
+            text = finduser_queries.get(int(search_id))
+        if text is None:
+            bot.answer_callback_query(call.id, "❌ Поиск устарел, повторите /finduser")
+            return
+        
+        result_text, markup = render_finduser_page(int(search_id), text, int(offset))
+        bot.edit_message_text(result_text, chat_id=call.message.chat.id, message_id=call.message.message_id,
+                              parse_mode='Markdown', reply_markup=markup)
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.error(f"Ошибка постраничного поиска: {e}")
+        bot.answer_callback_query(call.id, "❌ Ошибка")
+
+# ПРОФИЛИРОВЩИК
+# Выборки стеков всех потоков через sys._current_frames с частотой
+# 1/PROFILE_INTERVAL. Результат — свернутые стеки (формат flamegraph.pl,
+# speedscope): "поток;функция;...;функция число_выборок".
+profile_lock = threading.Lock()
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    me = threading.get_ident()
+    stacks = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            parts = []
+            while frame is not None:
+                parts.append(_frame_name(frame))
+                frame = frame.f_back
+            parts.append(names.get(ident, str(ident)))
+            stack = ';'.join(reversed(parts))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def run_profile(seconds, chat_id):
+    try:
+        stacks, samples = sample_stacks(seconds)
+        path = os.path.join(PROFILE_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        
+        leaves = {}
+        for stack, count in stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        top = sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:5]
+        top_text = '\n'.join(f"{count} — {leaf}" for leaf, count in top)
+        
+        bot.send_message(chat_id, f"🔬 Профиль готов: {samples} выборок за {seconds} сек.\n"
+                                  f"Файл: {path}\n\nЧаще всего на вершине стека:\n{top_text}")
+    except Exception as e:
+        logger.error(f"Ошибка профилирования: {e}")
+        bot.send_message(chat_id, f"❌ Ошибка профилирования: {e}")
+    finally:
+        profile_lock.release()
+
+@bot.message_handler(commands=['profile'])
+def profile_command(message):
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        bot.reply_to(message, "❌ Эта команда только для админов")
+        return
+    
+    parts = message.text.split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 30
+    except ValueError:
+        bot.reply_to(message, "❌ Формат: `/profile [сек]`", parse_mode='Markdown')
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    if not profile_lock.acquire(blocking=False):
+        bot.reply_to(message, "⏳ Профилирование уже идет")
+        return
+    
+    threading.Thread(target=run_profile, args=(seconds, message.chat.id), name="profiler", daemon=True).start()
+    bot.reply_to(message, f"🔬 Профилирую {seconds} сек...")
+
 # ОСТАЛЬНЫЕ ФУНКЦИИ (перенесены из предыдущего кода)
+@text_command('п', prefix=True)
 def process_payment_command(message):
     text = message.text.strip()
     
@@ -572,7 +2038,7 @@ def process_payment_command(message):
         
         target_id = message.reply_to_message.from_user.id
         
-        if target_id == bot.get_me().id:
+        if target_id == get_bot_identity().id:
             bot.reply_to(message, "❌ Нельзя переводить боту")
             return True
         
@@ -607,16 +2073,21 @@ def process_payment_command(message):
         return True
     
     try:
-        user_info = bot.get_chat(target_id)
+        user_info = get_chat_cached(target_id)
         if not (user_info.username or user_info.first_name):
             bot.reply_to(message, "❌ Нельзя переводить ботам")
             return True
-    except:
-        pass
+    except Exception as e:
+        logger.warning(f"Не удалось проверить получателя {target_id}: {e}")
     
-    update_balance(user_id, -amount)
-    update_balance(target_id, amount)
-    add_transaction(user_id, target_id, amount, "payment")
+    try:
+        balances = transfer(user_id, target_id, amount, "payment")
+    except InsufficientFunds:
+        bot.reply_to(message, f"❌ Недостаточно средств!\nВаш баланс: {get_user_balance(user_id)} GRAM")
+        return True
+    if not balances:
+        bot.reply_to(message, "❌ Перевод не выполнен, попробуйте позже")
+        return True
     
     sender_name = message.from_user.first_name or f"ID: {user_id}"
     target_name = target_user[3] or target_user[2] or f"ID: {target_id}"
@@ -627,24 +2098,22 @@ def process_payment_command(message):
 👤 Отправитель: *{sender_name}*
 👤 Получатель: *{target_name}*
 💰 Сумма: *{amount}* GRAM
-💳 Ваш новый баланс: *{get_user_balance(user_id)}* GRAM
+💳 Ваш новый баланс: *{balances[user_id]}* GRAM
 """, parse_mode='Markdown')
     
-    try:
-        bot.send_message(target_id, f"""
+    # Недоступный чат получателя отмечает исходящая очередь
+    notify('send_message', target_id, f"""
 💰 *ВАМ ПЕРЕВЕЛИ СРЕДСТВА*
 
 👤 Отправитель: *{sender_name}*
 💰 Сумма: *{amount}* GRAM
-💳 Ваш новый баланс: *{get_user_balance(target_id)}* GRAM
+💳 Ваш новый баланс: *{balances[target_id]}* GRAM
 """, parse_mode='Markdown')
-    except:
-        pass
     
     return True
 
 # БАЛАНС И БОНУС
-@bot.message_handler(func=lambda m: m.text.lower() in ['б', 'баланс'])
+@text_command('б', 'баланс')
 def show_balance(message):
     user_id = message.from_user.id
     balance = get_user_balance(user_id)
@@ -667,7 +2136,7 @@ def show_balance(message):
         show_bonus_button = True
     
     if show_bonus_button and user_id not in user_last_bonus_check:
-        user_last_bonus_check[user_id] = True
+        user_last_bonus_check[user_id] = time.monotonic()
         keyboard = [[InlineKeyboardButton("🎁 Бонус", callback_data="daily_bonus")]]
         markup = InlineKeyboardMarkup(keyboard)
     else:
@@ -681,7 +2150,22 @@ def show_balance(message):
 """
     bot.reply_to(message, balance_text, parse_mode='Markdown', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: m.text.lower() == 'бонус')
+@text_command('топ')
+def show_top(message):
+    user_id = message.from_user.id
+    
+    top_text = "🏆 *ТОП ИГРОКОВ:*\n\n"
+    for i, user in enumerate(get_leaderboard()[:LEADERBOARD_PUBLIC], 1):
+        username = user[2] or user[3] or f"ID: {user[0]}"
+        top_text += f"{i}. `{username.replace('`', '')}` — *{user[1]}* GRAM\n"
+    
+    rank = get_user_rank(user_id)
+    if rank:
+        top_text += f"\n📍 Ваше место: *#{rank}*"
+    
+    bot.reply_to(message, top_text, parse_mode='Markdown')
+
+@text_command('бонус')
 def bonus_command(message):
     user_id = message.from_user.id
     user = get_user(user_id)
@@ -706,9 +2190,11 @@ def bonus_command(message):
             bot.reply_to(message, f"⏳ Следующий бонус через {hours_left}ч {minutes_left}мин")
             return
     
-    new_balance = update_balance(user_id, DAILY_BONUS)
-    update_last_bonus(user_id)
-    add_transaction(0, user_id, DAILY_BONUS, "daily_bonus")
+    try:
+        new_balance = credit_daily_bonus(user_id)
+    except BonusAlreadyClaimed:
+        bot.reply_to(message, "⏳ Бонус уже получен")
+        return
     
     if user_id in user_last_bonus_check:
         del user_last_bonus_check[user_id]
@@ -722,7 +2208,6 @@ def bonus_command(message):
 Следующий бонус через 24 часа!
 """, parse_mode='Markdown')
 
-@bot.callback_query_handler(func=lambda call: call.data == "daily_bonus")
 def daily_bonus_callback(call):
     user_id = call.from_user.id
     user = get_user(user_id)
@@ -743,9 +2228,11 @@ def daily_bonus_callback(call):
             bot.answer_callback_query(call.id, f"⏳ Бонус через {hours_left}ч {minutes_left}мин")
             return
     
-    new_balance = update_balance(user_id, DAILY_BONUS)
-    update_last_bonus(user_id)
-    add_transaction(0, user_id, DAILY_BONUS, "daily_bonus")
+    try:
+        new_balance = credit_daily_bonus(user_id)
+    except BonusAlreadyClaimed:
+        bot.answer_callback_query(call.id, "⏳ Бонус уже получен")
+        return
     
     if user_id in user_last_bonus_check:
         del user_last_bonus_check[user_id]
@@ -796,239 +2283,735 @@ def parse_roulette_bet(bet_value):
     
     return None, None
 
-def add_roulette_bet(user_id, amount, bet_type, bet_value):
-    if user_id not in roulette_bets:
-        roulette_bets[user_id] = []
+ROULETTE_RED = frozenset((1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36))
+ROULETTE_BLACK = frozenset(range(1, 37)) - ROULETTE_RED
+ROULETTE_EVEN = frozenset(range(2, 37, 2))
+ROULETTE_ODD = frozenset(range(1, 37, 2))
+
+def roulette_bet_coverage(bet_type, bet_value):
+    # Числа, на которых ставка выигрывает, и множитель выплаты
+    if bet_type == 'number':
+        return (int(bet_value),), 36
+    if bet_type == 'color':
+        return ROULETTE_RED if bet_value == 'red' else ROULETTE_BLACK, 2
+    if bet_type == 'evenodd':
+        return ROULETTE_EVEN if bet_value == 'even' else ROULETTE_ODD, 2
+    start, end = map(int, bet_value.split('-'))
+    return range(start, end + 1), 36 / (end - start + 1)
+
+def describe_roulette_bet(bet_type, bet_value):
+    if bet_type == 'number':
+        return f"Число {bet_value}"
+    elif bet_type == 'color':
+        return "🔴 Красное" if bet_value == 'red' else "⚫ Черное"
+    elif bet_type == 'evenodd':
+        return "Четное" if bet_value == 'even' else "Нечетное"
+    elif bet_type == 'range':
+        return f"Диапазон {bet_value}"
+    return bet_value
+
+class RouletteBook:
+    # Ставки пользователя, разложенные по числам при приеме: payouts[n] — сколько
+    # выплатить, если выпадет n. stakes хранит сумму на каждый вид ставки для
+    # `ставки`. Размер не зависит от числа ставок: 37 слотов и не больше
+    # одной записи на вид ставки.
+    __slots__ = ('payouts', 'stakes', 'total', 'count')
+
+    def __init__(self):
+        self.payouts = [0] * 37
+        self.stakes = {}
+        self.total = 0
+        self.count = 0
+
+    def add(self, amount, bet_type, bet_value):
+        numbers, multiplier = roulette_bet_coverage(bet_type, bet_value)
+        win_amount = int(amount * multiplier)
+        for number in numbers:
+            self.payouts[number] += win_amount
+        key = bet_type + ':' + bet_value
+        self.stakes[key] = self.stakes.get(key, 0) + amount
+        self.total += amount
+        self.count += 1
+
+    def payout(self, number):
+        return self.payouts[number]
+
+    def to_state(self):
+        return [list(self.payouts), dict(self.stakes), self.count]
+
+    @classmethod
+    def from_state(cls, state):
+        book = cls()
+        book.payouts, book.stakes, book.count = state
+        book.total = sum(book.stakes.values())
+        return book
+
+def add_roulette_bets(user_id, amount, bets):
+    # Списание и новая книга ставок в game_state — одна транзакция.
+    # Книга в памяти заменяется только после COMMIT
+    book = get_user_roulette_book(user_id)
+    new_book = RouletteBook.from_state(book.to_state()) if book else RouletteBook()
+    for bet_type, bet_value in bets:
+        new_book.add(amount, bet_type, bet_value)
     
-    roulette_bets[user_id].append({
-        'amount': amount,
-        'type': bet_type,
-        'value': bet_value,
-        'time': time.time()
-    })
+    balances = ledger_apply([(user_id, -amount * len(bets))],
+                            extra=lambda c: _put_game(c, 'roulette', 0, user_id, new_book.to_state()))
+    if balances is None:
+        return None
+    roulette_bets[user_id] = new_book
+    track_roulette_bets(len(bets))
+    return balances[user_id]
 
-def get_user_roulette_bets(user_id):
-    return roulette_bets.get(user_id, [])
+def get_user_roulette_book(user_id):
+    restore_user_roulette_bets(user_id)
+    return roulette_bets.get(user_id)
 
 def clear_user_roulette_bets(user_id):
-    if user_id in roulette_bets:
-        del roulette_bets[user_id]
+    restore_user_roulette_bets(user_id)
+    book = roulette_bets.pop(user_id, None)
+    if book:
+        track_roulette_bets(-book.count)
+
+def settle_user_roulette_bets(user_id, payout, transaction=None):
+    # Выплата (выигрыш или возврат) и удаление ставок из game_state — одна транзакция
+    deltas = [(user_id, payout)] if payout else []
+    try:
+        balances = ledger_apply(deltas, transaction, extra=lambda c: _take_game(c, 'roulette', 0, user_id))
+    except GameSettled:
+        clear_user_roulette_bets(user_id)
+        raise
+    if balances is not None:
+        clear_user_roulette_bets(user_id)
+    return balances
+
+class MinesGame:
+    # Мины и открытые клетки — битовые маски (бит i = клетка i)
+    __slots__ = ('user_id', 'bet_amount', 'mines_count', 'grid_size', 'mines', 'revealed',
+                 'opened', 'current_payout', 'created_at', 'touched_at', 'chat_id', 'message_id')
+
+    def __init__(self, user_id, bet_amount, mines_count=MINES_COUNT, grid_size=GRID_SIZE):
+        self.user_id = user_id
+        self.bet_amount = bet_amount
+        self.mines_count = mines_count
+        self.grid_size = grid_size
+        self.mines = 0
+        for cell in random.sample(range(grid_size * grid_size), mines_count):
+            self.mines |= 1 << cell
+        self.revealed = 0
+        self.opened = 0
+        self.current_payout = bet_amount
+        self.created_at = time.monotonic()
+        self.touched_at = self.created_at
+        # Сообщение с полем: нужно, чтобы закрыть игру по таймауту
+        self.chat_id = None
+        self.message_id = None
+
+    def to_state(self):
+        return [self.user_id, self.bet_amount, self.mines_count, self.grid_size, self.mines,
+                self.revealed, self.current_payout, time.monotonic() - self.created_at,
+                self.chat_id, self.message_id, time.monotonic() - self.touched_at]
+
+    @classmethod
+    def from_state(cls, state):
+        (user_id, bet_amount, mines_count, grid_size, mines, revealed, current_payout, age,
+         chat_id, message_id, idle) = state
+        game = cls.__new__(cls)
+        game.user_id = user_id
+        game.bet_amount = bet_amount
+        game.mines_count = mines_count
+        game.grid_size = grid_size
+        game.mines = mines
+        game.revealed = revealed
+        game.opened = bin(revealed).count('1')
+        game.current_payout = current_payout
+        game.created_at = time.monotonic() - age
+        game.touched_at = time.monotonic() - idle
+        game.chat_id = chat_id
+        game.message_id = message_id
+        return game
+
+    def has_cell(self, cell):
+        return 0 <= cell < self.grid_size * self.grid_size
+
+    def is_mine(self, cell):
+        return self.mines >> cell & 1
+
+    def is_revealed(self, cell):
+        return self.revealed >> cell & 1
+
+    def reveal(self, cell):
+        self.revealed |= 1 << cell
+        self.opened += 1
+
+# КЛАВИАТУРЫ МИН
+# Клавиатура собирается готовым JSON из общих шаблонов строк: для каждой строки
+# поля заранее сериализованы все варианты открытых в ней клеток, вариант
+# выбирается по битовой маске игры. Игра ничего не хранит, Telegram получает
+# строку без пересборки InlineKeyboardMarkup.
+def _button_json(text, callback_data):
+    return json.dumps({'text': text, 'callback_data': callback_data})
+
+def _keyboard_json(rows):
+    return '{"inline_keyboard": [' + ', '.join(rows) + ']}'
+
+def _row_json(buttons):
+    return '[' + ', '.join(buttons) + ']'
+
+MINES_CELL_GEM = _button_json("💎", "noop")
+MINES_CELL_MINE = _button_json("💣", "noop")
+MINES_CELL_EXPLODED = _button_json("💥", "noop")
+MINES_CELL_CLOSED = _button_json("🟦", "noop")
+MINES_HIDDEN_CELLS = [_button_json("🟦", f"mines_GAME_ID_{cell}") for cell in range(GRID_SIZE * GRID_SIZE)]
+MINES_CONTROL_ROW = _row_json([_button_json("💰 Забрать", "mines_GAME_ID_cashout"),
+                               _button_json("❌ Закончить", "mines_GAME_ID_end")])
+MINES_ROW_MASK = (1 << GRID_SIZE) - 1
+# MINES_ROW_TEMPLATES[строка][маска открытых клеток строки]
+MINES_ROW_TEMPLATES = [
+    [_row_json([MINES_CELL_GEM if mask >> col & 1 else MINES_HIDDEN_CELLS[row * GRID_SIZE + col]
+                for col in range(GRID_SIZE)])
+     for mask in range(1 << GRID_SIZE)]
+    for row in range(GRID_SIZE)]
+MINES_INITIAL_KEYBOARD = _keyboard_json(
+    [_row_json(MINES_HIDDEN_CELLS[row * GRID_SIZE:(row + 1) * GRID_SIZE]) for row in range(GRID_SIZE)]
+    + [MINES_CONTROL_ROW])
+
+def mines_initial_keyboard(game_id):
+    return MINES_INITIAL_KEYBOARD.replace('GAME_ID', str(game_id))
+
+def mines_reveal_keyboard(game_id, game):
+    rows = [MINES_ROW_TEMPLATES[row][game.revealed >> row * GRID_SIZE & MINES_ROW_MASK] for row in range(GRID_SIZE)]
+    rows.append(MINES_CONTROL_ROW)
+    return _keyboard_json(rows).replace('GAME_ID', str(game_id))
+
+def mines_lost_keyboard(game, exploded):
+    # exploded — клетка, на которой игрок подорвался
+    size = game.grid_size
+    cells = [MINES_CELL_EXPLODED if cell == exploded else MINES_CELL_MINE if game.is_mine(cell)
+             else MINES_CELL_GEM if game.is_revealed(cell) else MINES_CELL_CLOSED
+             for cell in range(size * size)]
+    return _keyboard_json([_row_json(cells[row * size:(row + 1) * size]) for row in range(size)])
+
+# Случайное начало, чтобы кнопки игр до перезапуска не попадали в новые игры
+mines_game_ids = itertools.count(random.randrange(1 << 24, 1 << 30))
+
+# СОХРАНЕНИЕ СОСТОЯНИЯ ИГР
+# Игры, в которых лежат деньги, хранятся в таблице game_state. Строка
+# создается той же транзакцией леджера, что списывает ставку, и удаляется той
+# же, что выплачивает выигрыш: после перезапуска не теряются принятые ставки и
+# не возвращаются рассчитанные игры. Удаление строки — отметка о расчете: если
+# строки уже нет, второй расчет откатывается (GameSettled).
+# Ходы в минах деньги не двигают: фоновый поток раз в MINES_PROGRESS_INTERVAL
+# пишет их только UPDATE'ом, который не может вернуть удаленную игру. При
+# старте строки читаются одним запросом, объекты игр создаются при первом
+# обращении.
+restored_mines = {}
+restored_roulette_bets = {}
+mines_progress = set()
+mines_progress_lock = threading.Lock()
+# Число принятых и еще не рассчитанных ставок рулетки (личных и на столах)
+active_roulette_bets = {'count': 0}
+active_roulette_lock = threading.Lock()
+
+def track_roulette_bets(delta):
+    with active_roulette_lock:
+        active_roulette_bets['count'] += delta
+
+def _put_game(c, kind, game_id, user_id, state):
+    c.execute("INSERT OR REPLACE INTO game_state (kind, id, user_id, state) VALUES (?, ?, ?, ?)",
+              (kind, game_id, user_id, json.dumps(state)))
+
+def _take_game(c, kind, game_id, user_id):
+    c.execute("DELETE FROM game_state WHERE kind = ? AND id = ? AND user_id = ?", (kind, game_id, user_id))
+    if c.rowcount == 0:
+        raise GameSettled(kind, game_id, user_id)
+
+def mark_mines_progress(game_id):
+    with mines_progress_lock:
+        mines_progress.add(game_id)
+
+def finish_mines_game(game_id, game, payout=0, transaction=None):
+    # Снять игру с поля и рассчитать: выплата и удаление строки — одна транзакция.
+    # GameSettled — игру уже закрыли (другой клик или таймер); None — ошибка БД,
+    # игра возвращается на поле
+    if mines_games.pop(game_id, None) is None:
+        raise GameSettled('mines', game_id, game.user_id)
+    with mines_progress_lock:
+        mines_progress.discard(game_id)
+    
+    deltas = [(game.user_id, payout)] if payout else []
+    balances = ledger_apply(deltas, transaction, extra=lambda c: _take_game(c, 'mines', game_id, game.user_id))
+    if balances is None:
+        mines_games[game_id] = game
+    return balances
+
+def set_mines_message(game_id, game, sent):
+    game.message_id = sent.message_id
+    mark_mines_progress(game_id)
+
+def get_mines_game(game_id):
+    game = mines_games.get(game_id)
+    if game is None and restored_mines:
+        state = restored_mines.pop(game_id, None)
+        if state:
+            game = mines_games.setdefault(game_id, MinesGame.from_state(state))
+    return game
+
+def restore_user_roulette_bets(user_id):
+    if restored_roulette_bets:
+        state = restored_roulette_bets.pop(user_id, None)
+        if state:
+            roulette_bets.setdefault(user_id, RouletteBook.from_state(state))
+
+def count_active_mines():
+    return len(mines_games) + len(restored_mines)
+
+def count_active_roulette_bets():
+    return active_roulette_bets['count']
+
+def flush_mines_progress():
+    with mines_progress_lock:
+        game_ids = list(mines_progress)
+        mines_progress.clear()
+    
+    rows = []
+    for game_id in game_ids:
+        game = mines_games.get(game_id)
+        if game is not None:
+            rows.append((json.dumps(game.to_state()), game_id))
+    if rows:
+        db_write(lambda c: c.executemany("UPDATE game_state SET state = ? WHERE kind = 'mines' AND id = ?", rows))
+
+def load_game_state():
+    global mines_game_ids
+    tables = {}
+    for kind, game_id, user_id, state in db_read("SELECT kind, id, user_id, state FROM game_state", one=False):
+        if kind == 'mines':
+            restored_mines[game_id] = json.loads(state)
+        elif kind == 'roulette':
+            restored_roulette_bets[user_id] = json.loads(state)
+        elif kind == 'table':
+            tables.setdefault(game_id, {})[user_id] = json.loads(state)
+    
+    # state[2] — число ставок в книге (RouletteBook.to_state)
+    track_roulette_bets(sum(state[2] for state in restored_roulette_bets.values()))
+    for chat_id, books in tables.items():
+        restore_table(chat_id, books)
+    
+    if restored_mines:
+        mines_game_ids = itertools.count(max(restored_mines) + 1)
+    for game_id, state in restored_mines.items():
+        schedule_mines_expiry(game_id, max(0, MINES_GAME_TTL - state[10]))
+    logger.info(f"♻️ Восстановлено: игр в мины {len(restored_mines)}, ставок рулетки {len(restored_roulette_bets)}, "
+                f"столов {len(roulette_tables)}")
+
+def _progress_flusher():
+    while True:
+        time.sleep(MINES_PROGRESS_INTERVAL)
+        try:
+            flush_mines_progress()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения ходов в минах: {e}")
+
+def start_progress_flusher():
+    atexit.register(flush_mines_progress)
+    threading.Thread(target=_progress_flusher, name="mines-progress", daemon=True).start()
+
+# ИСТЕЧЕНИЕ ИГР
+# У каждой игры в мины одна запись в планировщике. При срабатывании проверяется
+# время последнего хода: если игрок еще играл, запись переносится. Игру
+# рассчитывает тот, кто первым снял ее из mines_games, — таймер или кнопка.
+expiry_stats = {'mines_cashout': 0, 'mines_forfeit': 0, 'roulette_timers': 0, 'bonus_flags': 0}
+
+def when_sent(result, callback):
+    # Исходящая очередь и async рантайм возвращают Future
+    if isinstance(result, Future):
+        result.add_done_callback(lambda f: not f.cancelled() and f.exception() is None and callback(f.result()))
+    elif result is not None:
+        callback(result)
+
+def sent_result(result):
+    # Дождаться ответа Telegram, когда он нужен (ошибки доставки в рассылке)
+    return result.result() if isinstance(result, Future) else result
+
+def schedule_mines_expiry(game_id, delay=MINES_GAME_TTL):
+    scheduler.schedule(delay, expire_mines_game, game_id)
+
+def expire_mines_game(game_id):
+    game = get_mines_game(game_id)
+    if game is None:
+        return
+    with user_lock(game.user_id):
+        _expire_mines_game(game_id, game)
+
+def _expire_mines_game(game_id, game):
+    idle = time.monotonic() - game.touched_at
+    if idle < MINES_GAME_TTL:
+        schedule_mines_expiry(game_id, MINES_GAME_TTL - idle)
+        return
+    
+    payout, transaction = 0, None
+    if MINES_EXPIRE_ACTION != 'forfeit':
+        payout = game.current_payout
+        transaction = (0, game.user_id, game.current_payout - game.bet_amount, "mines_win")
+    try:
+        balances = finish_mines_game(game_id, game, payout, transaction)
+    except GameSettled:
+        return
+    if balances is None:
+        schedule_mines_expiry(game_id, EXPIRY_SWEEP_INTERVAL)
+        return
+    
+    if MINES_EXPIRE_ACTION == 'forfeit':
+        expiry_stats['mines_forfeit'] += 1
+        text = f"""
+⌛ *МИНЫ | ВРЕМЯ ВЫШЛО*
+
+💰 Ставка: *{game.bet_amount}* GRAM
+💸 Ставка сгорела
+
+Игра без ходов дольше {MINES_GAME_TTL // 60} мин. закрыта автоматически.
+"""
+    else:
+        win_amount = game.current_payout - game.bet_amount
+        expiry_stats['mines_cashout'] += 1
+        text = f"""
+⌛ *МИНЫ | ВРЕМЯ ВЫШЛО*
+
+💰 Ставка: *{game.bet_amount}* GRAM
+🎯 Выплачено: *{game.current_payout}* GRAM
+💎 Прибыль: *{win_amount}* GRAM
+
+Игра без ходов дольше {MINES_GAME_TTL // 60} мин. закрыта автоматически.
+"""
+    
+    if game.chat_id and game.message_id:
+        notify('edit_message_text', text, chat_id=game.chat_id, message_id=game.message_id, parse_mode='Markdown')
+
+def sweep_stale_entries():
+    # Истекшие кулдауны рулетки ничем не отличаются от отсутствующих
+    now = time.time()
+    for user_id, until in list(roulette_timers.items()):
+        if until < now and roulette_timers.pop(user_id, None) is not None:
+            expiry_stats['roulette_timers'] += 1
+    
+    # Флаг показанной кнопки бонуса живет BONUS_FLAG_TTL, потом кнопка покажется снова
+    oldest = time.monotonic() - BONUS_FLAG_TTL
+    for user_id, checked_at in list(user_last_bonus_check.items()):
+        if checked_at < oldest and user_last_bonus_check.pop(user_id, None) is not None:
+            expiry_stats['bonus_flags'] += 1
+    
+    outbox.evict_idle()
+    scheduler.schedule(EXPIRY_SWEEP_INTERVAL, sweep_stale_entries)
+
+scheduler.schedule(EXPIRY_SWEEP_INTERVAL, sweep_stale_entries)
 
 def get_mines_multiplier(opened_cells):
     multipliers = [1.00, 1.28, 1.65, 2.10, 2.65, 3.30, 4.05, 5.00, 6.15, 7.50,
                    9.15, 11.10, 13.45, 16.30, 19.75, 23.90, 29.00, 35.20, 42.70, 51.80, 62.90]
     return multipliers[opened_cells] if opened_cells < len(multipliers) else multipliers[-1]
 
-@bot.message_handler(func=lambda m: True)
-def handle_all_messages(message):
-    text = message.text.strip()
+@text_command('ставки')
+def show_roulette_bets(message):
     user_id = message.from_user.id
     
-    if process_payment_command(message):
+    if is_table_chat(message.chat):
+        book = get_table_book(message.chat.id, user_id)
+    else:
+        book = get_user_roulette_book(user_id)
+    
+    if not book:
+        bot.reply_to(message, "📭 У вас нет активных ставок")
         return
     
-    if text.lower() in ['ставки']:
-        bets = get_user_roulette_bets(user_id)
-        
-        if not bets:
-            bot.reply_to(message, "📭 У вас нет активных ставок")
-            return
-        
-        total_amount = sum(bet['amount'] for bet in bets)
-        
-        bets_text = "📋 *ВАШИ СТАВКИ:*\n\n"
-        for i, bet in enumerate(bets, 1):
-            bet_type = bet['type']
-            bet_value = bet['value']
-            amount = bet['amount']
-            
-            if bet_type == 'number':
-                bet_desc = f"Число {bet_value}"
-            elif bet_type == 'color':
-                color = "🔴 Красное" if bet_value == 'red' else "⚫ Черное"
-                bet_desc = color
-            elif bet_type == 'evenodd':
-                parity = "Четное" if bet_value == 'even' else "Нечетное"
-                bet_desc = parity
-            elif bet_type == 'range':
-                bet_desc = f"Диапазон {bet_value}"
-            else:
-                bet_desc = bet_value
-            
-            bets_text += f"{i}. {bet_desc} — *{amount}* GRAM\n"
-        
-        bets_text += f"\n💰 *Общая сумма:* {total_amount} GRAM"
-        bot.reply_to(message, bets_text, parse_mode='Markdown')
+    # Одинаковые ставки показываются одной строкой с общей суммой
+    bets_text = "📋 *ВАШИ СТАВКИ:*\n\n"
+    for i, (key, amount) in enumerate(list(book.stakes.items()), 1):
+        bet_desc = describe_roulette_bet(*key.split(':', 1))
+        bets_text += f"{i}. {bet_desc} — *{amount}* GRAM\n"
+    
+    bets_text += f"\n🎯 Ставок: {book.count}"
+    bets_text += f"\n💰 *Общая сумма:* {book.total} GRAM"
+    bot.reply_to(message, bets_text, parse_mode='Markdown')
+
+@text_command('отмена')
+def cancel_roulette_bets(message):
+    user_id = message.from_user.id
+    
+    try:
+        if is_table_chat(message.chat):
+            # Под блокировкой стола: раунд не рассчитает эти ставки одновременно с возвратом
+            book, balances = cancel_table_bets(message.chat.id, user_id)
+        else:
+            book = get_user_roulette_book(user_id)
+            balances = settle_user_roulette_bets(user_id, book.total) if book else None
+    except GameSettled:
+        book = None
+    
+    if not book:
+        bot.reply_to(message, "📭 Нет ставок для отмены")
+        return
+    if balances is None:
+        bot.reply_to(message, "❌ Ошибка, попробуйте позже")
         return
     
-    if text.lower() == 'отмена':
-        bets = get_user_roulette_bets(user_id)
-        
-        if not bets:
-            bot.reply_to(message, "📭 Нет ставок для отмены")
-            return
-        
-        total_amount = sum(bet['amount'] for bet in bets)
-        
-        update_balance(user_id, total_amount)
-        clear_user_roulette_bets(user_id)
-        
-        bot.reply_to(message, f"""
+    bot.reply_to(message, f"""
 ❌ *СТАВКИ ОТМЕНЕНЫ*
 
-💰 Возвращено: *{total_amount}* GRAM
-💳 Новый баланс: *{get_user_balance(user_id)}* GRAM
+💰 Возвращено: *{book.total}* GRAM
+💳 Новый баланс: *{balances[user_id]}* GRAM
 """, parse_mode='Markdown')
+
+@text_command('го')
+def spin_roulette(message):
+    user_id = message.from_user.id
+    
+    if is_table_chat(message.chat):
+        spin_at = get_table_spin_at(message.chat.id)
+        if spin_at is None:
+            bot.reply_to(message, "❌ Нет активных ставок на столе")
+        else:
+            bot.reply_to(message, f"🎡 Стол крутится сам: раунд через {max(0, int(spin_at - time.time()))} сек.")
         return
     
-    if text.lower() == 'го':
-        bets = get_user_roulette_bets(user_id)
-        
-        if not bets:
-            bot.reply_to(message, "❌ Нет активных ставок")
+    book = get_user_roulette_book(user_id)
+    
+    if not book:
+        bot.reply_to(message, "❌ Нет активных ставок")
+        return
+    
+    if user_id in roulette_timers:
+        time_left = roulette_timers[user_id] - time.time()
+        if time_left > 0:
+            bot.reply_to(message, f"⏳ Раунд можно начать через {int(time_left)} сек.")
             return
-        
-        if user_id in roulette_timers:
-            time_left = roulette_timers[user_id] - time.time()
-            if time_left > 0:
-                bot.reply_to(message, f"⏳ Раунд можно начать через {int(time_left)} сек.")
-                return
-        
-        roulette_number = random.randint(0, 36)
-        is_red = roulette_number in [1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 32, 34, 36]
-        is_black = roulette_number in [2, 4, 6, 8, 10, 11, 13, 15, 17, 20, 22, 24, 26, 28, 29, 31, 33, 35]
-        is_even = roulette_number % 2 == 0 and roulette_number != 0
-        
-        total_win = 0
-        winning_bets = []
-        
-        for bet in bets:
-            amount = bet['amount']
-            bet_type = bet['type']
-            bet_value = bet['value']
-            win = False
-            multiplier = 0
-            
-            if bet_type == 'number':
-                if int(bet_value) == roulette_number:
-                    win = True
-                    multiplier = 36
-            elif bet_type == 'color':
-                if bet_value == 'red' and is_red:
-                    win = True
-                    multiplier = 2
-                elif bet_value == 'black' and is_black:
-                    win = True
-                    multiplier = 2
-            elif bet_type == 'evenodd':
-                if bet_value == 'even' and is_even:
-                    win = True
-                    multiplier = 2
-                elif bet_value == 'odd' and not is_even and roulette_number != 0:
-                    win = True
-                    multiplier = 2
-            elif bet_type == 'range':
-                start, end = map(int, bet_value.split('-'))
-                if start <= roulette_number <= end:
-                    win = True
-                    range_size = end - start + 1
-                    multiplier = 36 / range_size
-            
-            if win:
-                win_amount = int(amount * multiplier)
-                total_win += win_amount
-                winning_bets.append((bet, win_amount))
-        
-        if total_win > 0:
-            update_balance(user_id, total_win)
-            add_transaction(0, user_id, total_win, "roulette_win")
-        
-        total_bet = sum(bet['amount'] for bet in bets)
-        color = "🟢 ZERO" if roulette_number == 0 else "🔴 RED" if is_red else "⚫ BLACK"
-        
-        result_text = f"""
+    
+    roulette_number = random.randint(0, 36)
+    is_red = roulette_number in ROULETTE_RED
+    total_win = book.payout(roulette_number)
+    
+    try:
+        balances = settle_user_roulette_bets(user_id, total_win,
+                                             (0, user_id, total_win, "roulette_win") if total_win > 0 else None)
+    except GameSettled:
+        bot.reply_to(message, "❌ Нет активных ставок")
+        return
+    if balances is None:
+        bot.reply_to(message, "❌ Ошибка, попробуйте позже")
+        return
+    new_balance = balances[user_id] if total_win > 0 else get_user_balance(user_id)
+    
+    total_bet = book.total
+    color = "🟢 ZERO" if roulette_number == 0 else "🔴 RED" if is_red else "⚫ BLACK"
+    
+    result_text = f"""
 🎰 *РУЛЕТКА РАУНД*
 
 🎯 Выпало: *{roulette_number}* ({color})
-💰 Всего ставок: *{len(bets)}*
+💰 Всего ставок: *{book.count}*
 💸 Общая ставка: *{total_bet}* GRAM
 """
-        
-        if total_win > 0:
-            result_text += f"""
+    
+    if total_win > 0:
+        result_text += f"""
 🏆 *ВЫИГРЫШ!*
 💰 Выигрыш: *{total_win}* GRAM
 💎 Прибыль: *{total_win - total_bet}* GRAM
 """
-        else:
-            result_text += "\n💸 *ПРОИГРЫШ*"
-        
-        result_text += f"\n💳 Новый баланс: *{get_user_balance(user_id)}* GRAM"
-        
-        clear_user_roulette_bets(user_id)
-        roulette_timers[user_id] = time.time() + ROULETTE_COOLDOWN
-        
-        bot.reply_to(message, result_text, parse_mode='Markdown')
-        return
+    else:
+        result_text += "\n💸 *ПРОИГРЫШ*"
     
-    if text.lower().startswith('мины '):
-        parts = text.split()
-        if len(parts) != 2:
-            bot.reply_to(message, "❌ Формат: `мины [сумма]`\nПример: `мины 50`")
-            return
-        
-        try:
-            amount = int(parts[1])
-        except:
-            bot.reply_to(message, "❌ Сумма должна быть числом")
-            return
-        
-        if amount < MINES_MIN_BET:
-            bot.reply_to(message, f"❌ Минимальная ставка: {MINES_MIN_BET} GRAM")
+    result_text += f"\n💳 Новый баланс: *{new_balance}* GRAM"
+    
+    roulette_timers[user_id] = time.time() + ROULETTE_COOLDOWN
+    
+    bot.reply_to(message, result_text, parse_mode='Markdown')
+
+# СТОЛЫ РУЛЕТКИ
+# В группах ставки всех игроков чата попадают в общий раунд. Первая ставка
+# ставит вращение в планировщик через ROULETTE_COOLDOWN; раунд — одно число
+# на всех, выплаты победителям одной транзакцией и одно сообщение с итогами.
+# Ставка, отмена и раунд одного стола идут по очереди под table_lock: запись в
+# game_state и изменение стола в памяти не расходятся. Порядок блокировок —
+# сначала пользователь, потом стол.
+roulette_tables = {}
+roulette_tables_lock = threading.Lock()
+table_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+def table_lock(chat_id):
+    return table_locks[chat_id % USER_LOCK_STRIPES]
+
+class RouletteTable:
+    __slots__ = ('books', 'spin_at')
+
+    def __init__(self, spin_at):
+        self.books = {}
+        self.spin_at = spin_at
+
+def is_table_chat(chat):
+    return ROULETTE_TABLES and chat.type in ('group', 'supergroup')
+
+def _open_table(chat_id, spin_at):
+    # Вызывается под roulette_tables_lock
+    table = roulette_tables[chat_id] = RouletteTable(spin_at)
+    scheduler.schedule(max(0, spin_at - time.time()), spin_table, chat_id)
+    return table
+
+def add_table_bets(chat_id, user_id, amount, bets):
+    # Списание и книга игрока на столе в game_state — одна транзакция.
+    # Возвращает (баланс, время раунда) или None при ошибке БД
+    with table_lock(chat_id):
+        with roulette_tables_lock:
+            table = roulette_tables.get(chat_id)
+            spin_at = table.spin_at if table else time.time() + ROULETTE_COOLDOWN
+            book = table.books.get(user_id) if table else None
+        new_book = RouletteBook.from_state(book.to_state()) if book else RouletteBook()
+        for bet_type, bet_value in bets:
+            new_book.add(amount, bet_type, bet_value)
+        
+        balances = ledger_apply([(user_id, -amount * len(bets))],
+                                extra=lambda c: _put_game(c, 'table', chat_id, user_id, [spin_at, new_book.to_state()]))
+        if balances is None:
+            return None
+        with roulette_tables_lock:
+            table = roulette_tables.get(chat_id) or _open_table(chat_id, spin_at)
+            table.books[user_id] = new_book
+    track_roulette_bets(len(bets))
+    return balances[user_id], spin_at
+
+def get_table_book(chat_id, user_id):
+    with roulette_tables_lock:
+        table = roulette_tables.get(chat_id)
+        return table.books.get(user_id) if table else None
+
+def cancel_table_bets(chat_id, user_id):
+    # Возврат и удаление книги игрока из game_state — одна транзакция
+    with table_lock(chat_id):
+        book = get_table_book(chat_id, user_id)
+        if book is None:
+            return None, None
+        balances = ledger_apply([(user_id, book.total)], extra=lambda c: _take_game(c, 'table', chat_id, user_id))
+        if balances is None:
+            return book, None
+        with roulette_tables_lock:
+            table = roulette_tables.get(chat_id)
+            if table:
+                table.books.pop(user_id, None)
+    track_roulette_bets(-book.count)
+    return book, balances
+
+def get_table_spin_at(chat_id):
+    with roulette_tables_lock:
+        table = roulette_tables.get(chat_id)
+        return table.spin_at if table else None
+
+def restore_table(chat_id, books):
+    # books: {user_id: [время раунда, книга]} из game_state
+    with roulette_tables_lock:
+        table = _open_table(chat_id, min(spin_at for spin_at, _ in books.values()))
+        table.books.update((user_id, RouletteBook.from_state(book)) for user_id, (_, book) in books.items())
+        track_roulette_bets(sum(book.count for book in table.books.values()))
+
+def spin_table(chat_id):
+    with table_lock(chat_id):
+        with roulette_tables_lock:
+            table = roulette_tables.pop(chat_id, None)
+        if table is None or not table.books:
             return
         
-        balance = get_user_balance(user_id)
-        
-        if balance < amount:
-            bot.reply_to(message, f"❌ Недостаточно средств!\nВаш баланс: {balance} GRAM")
+        roulette_number = random.randint(0, 36)
+        winners = [(user_id, book.payout(roulette_number)) for user_id, book in table.books.items()
+                   if book.payout(roulette_number) > 0]
+        winners.sort(key=lambda winner: winner[1], reverse=True)
+        transactions = [(0, user_id, win_amount, "roulette_win") for user_id, win_amount in winners]
+        
+        def settle(c):
+            c.executemany("INSERT INTO transactions (from_user, to_user, amount, type) VALUES (?, ?, ?, ?)",
+                          transactions)
+            c.execute("DELETE FROM game_state WHERE kind = 'table' AND id = ?", (chat_id,))
+        
+        if ledger_apply(winners, extra=settle) is None:
+            # Ставки остались в game_state — возвращаем стол и пробуем позже
+            logger.error(f"❌ Не удалось рассчитать стол {chat_id}, повтор через {ROULETTE_COOLDOWN} сек.")
+            with roulette_tables_lock:
+                roulette_tables[chat_id] = table
+            scheduler.schedule(ROULETTE_COOLDOWN, spin_table, chat_id)
             return
-        
-        grid_size = GRID_SIZE
-        total_cells = grid_size * grid_size
-        
-        mine_positions = random.sample(range(total_cells), MINES_COUNT)
-        game_id = str(uuid.uuid4())[:8]
-        
-        mines_games[game_id] = {
-            'user_id': user_id,
-            'bet_amount': amount,
-            'mines_count': MINES_COUNT,
-            'grid_size': grid_size,
-            'mine_positions': mine_positions,
-            'revealed_cells': [],
-            'current_payout': amount,
-            'created_at': datetime.now()
-        }
-        
-        update_balance(user_id, -amount)
-        add_transaction(user_id, 0, amount, "mines_bet")
-        
-        keyboard = []
-        for row in range(grid_size):
-            row_buttons = []
-            for col in range(grid_size):
-                cell_index = row * grid_size + col
-                row_buttons.append(InlineKeyboardButton("🟦", callback_data=f"mines_{game_id}_{cell_index}"))
-            keyboard.append(row_buttons)
-        
-        keyboard.append([
-            InlineKeyboardButton("💰 Забрать", callback_data=f"mines_{game_id}_cashout"),
-            InlineKeyboardButton("❌ Закончить", callback_data=f"mines_{game_id}_end")
-        ])
-        
-        markup = InlineKeyboardMarkup(keyboard)
-        
-        game_text = f"""
+    track_roulette_bets(-sum(book.count for book in table.books.values()))
+    
+    is_red = roulette_number in ROULETTE_RED
+    color = "🟢 ZERO" if roulette_number == 0 else "🔴 RED" if is_red else "⚫ BLACK"
+    total_bet = sum(book.total for book in table.books.values())
+    
+    result_text = f"""
+🎡 *СТОЛ РУЛЕТКИ | РАУНД*
+
+🎯 Выпало: *{roulette_number}* ({color})
+👥 Игроков: *{len(table.books)}*
+💸 Общая ставка: *{total_bet}* GRAM
+"""
+    
+    if winners:
+        result_text += f"\n🏆 *ПОБЕДИТЕЛИ:* {len(winners)}\n"
+        for user_id, win_amount in winners[:ROULETTE_TABLE_WINNERS_SHOWN]:
+            user = get_user_row(user_id)
+            # Имя в `...`, как в /finduser: * и _ из имени не ломают Markdown
+            username = ((user[2] or user[3]) if user else None) or f"ID: {user_id}"
+            result_text += f"• `{username.replace('`', '')}` — *{win_amount}* GRAM\n"
+        if len(winners) > ROULETTE_TABLE_WINNERS_SHOWN:
+            result_text += f"…и еще {len(winners) - ROULETTE_TABLE_WINNERS_SHOWN}\n"
+    else:
+        result_text += "\n💸 *Никто не выиграл*"
+    
+    notify('send_message', chat_id, result_text, parse_mode='Markdown')
+
+@text_command('мины', prefix=True)
+def start_mines(message):
+    text = message.text.strip()
+    user_id = message.from_user.id
+    
+    parts = text.split()
+    if len(parts) != 2:
+        bot.reply_to(message, "❌ Формат: `мины [сумма]`\nПример: `мины 50`")
+        return
+    
+    try:
+        amount = int(parts[1])
+    except:
+        bot.reply_to(message, "❌ Сумма должна быть числом")
+        return
+    
+    if amount < MINES_MIN_BET:
+        bot.reply_to(message, f"❌ Минимальная ставка: {MINES_MIN_BET} GRAM")
+        return
+    
+    balance = get_user_balance(user_id)
+    
+    if balance < amount:
+        bot.reply_to(message, f"❌ Недостаточно средств!\nВаш баланс: {balance} GRAM")
+        return
+    
+    grid_size = GRID_SIZE
+    game_id = next(mines_game_ids)
+    game = MinesGame(user_id, amount)
+    game.chat_id = message.chat.id
+    
+    # Списание и запись игры в game_state — одна транзакция
+    try:
+        balances = ledger_apply([(user_id, -amount)], (user_id, 0, amount, "mines_bet"),
+                                extra=lambda c: _put_game(c, 'mines', game_id, user_id, game.to_state()))
+    except InsufficientFunds:
+        bot.reply_to(message, f"❌ Недостаточно средств!\nВаш баланс: {get_user_balance(user_id)} GRAM")
+        return
+    if balances is None:
+        bot.reply_to(message, "❌ Ошибка, попробуйте позже")
+        return
+    
+    mines_games[game_id] = game
+    schedule_mines_expiry(game_id)
+    
+    markup = mines_initial_keyboard(game_id)
+    
+    game_text = f"""
 💣 *МИНЫ | ИГРА НАЧАТА*
 
 💰 Ставка: *{amount}* GRAM
@@ -1040,66 +3023,112 @@ def handle_all_messages(message):
 
 ⚠️ Выберите клетку.
 """
-        bot.reply_to(message, game_text, parse_mode='Markdown', reply_markup=markup)
-        return
+    sent = bot.reply_to(message, game_text, parse_mode='Markdown', reply_markup=markup)
+    when_sent(sent, lambda sent: set_mines_message(game_id, game, sent))
+
+def place_roulette_bets(message):
+    text = message.text.strip()
+    user_id = message.from_user.id
     
     parts = text.split()
-    if len(parts) >= 2:
-        try:
-            amount = int(parts[0])
-        except:
-            return
-        
-        if amount < MIN_BET:
-            bot.reply_to(message, f"❌ Минимальная ставка: {MIN_BET} GRAM")
-            return
-        
-        balance = get_user_balance(user_id)
-        
-        total_bet = amount * (len(parts) - 1)
-        
-        if balance < total_bet:
-            bot.reply_to(message, f"❌ Недостаточно средств!\nНужно: {total_bet} GRAM\nВаш баланс: {balance} GRAM")
-            return
+    try:
+        amount = int(parts[0])
+    except:
+        return
+    
+    if amount < MIN_BET:
+        bot.reply_to(message, f"❌ Минимальная ставка: {MIN_BET} GRAM")
+        return
+    
+    bets = []
+    for bet_value in parts[1:]:
+        bet_type, parsed_value = parse_roulette_bet(bet_value)
+        
+        if bet_type and parsed_value:
+            bets.append((bet_type, parsed_value))
+    bets_added = len(bets)
+    if bets_added == 0:
+        bot.reply_to(message, "❌ Некорректные ставки\nДоступно: числа 0-36, к/ч, чет/нечет, диапазон (1-18)")
+        return
+    
+    # Списывается только за распознанные ставки
+    total_bet = amount * bets_added
+    balance = get_user_balance(user_id)
+    if balance < total_bet:
+        bot.reply_to(message, f"❌ Недостаточно средств!\nНужно: {total_bet} GRAM\nВаш баланс: {balance} GRAM")
+        return
+    
+    # Ставки принимаются той же транзакцией, что списывает деньги
+    table_chat = is_table_chat(message.chat)
+    try:
+        if table_chat:
+            placed = add_table_bets(message.chat.id, user_id, amount, bets)
+        else:
+            placed = add_roulette_bets(user_id, amount, bets)
+    except InsufficientFunds:
+        bot.reply_to(message, f"❌ Недостаточно средств!\nНужно: {total_bet} GRAM\nВаш баланс: {get_user_balance(user_id)} GRAM")
+        return
+    if placed is None:
+        bot.reply_to(message, "❌ Ошибка, попробуйте позже")
+        return
+    
+    if table_chat:
+        new_balance, spin_at = placed
         
-        bets_added = 0
-        for bet_value in parts[1:]:
-            bet_type, parsed_value = parse_roulette_bet(bet_value)
-            
-            if bet_type and parsed_value:
-                add_roulette_bet(user_id, amount, bet_type, parsed_value)
-                bets_added += 1
+        bot.reply_to(message, f"""
+✅ *СТАВКА НА СТОЛЕ*
+
+💰 Общая сумма: *{total_bet}* GRAM ({amount} × {bets_added})
+🎯 Количество ставок: *{bets_added}*
+💳 Новый баланс: *{new_balance}* GRAM
+
+🎡 Раунд через *{max(0, int(spin_at - time.time()))}* сек.
+`ставки` - мои ставки, `отмена` - снять ставки
+""", parse_mode='Markdown')
+    else:
+        new_balance = placed
         
-        if bets_added > 0:
-            update_balance(user_id, -total_bet)
-            
-            bot.reply_to(message, f"""
+        bot.reply_to(message, f"""
 ✅ *СТАВКА ПРИНЯТА*
 
 💰 Общая сумма: *{total_bet}* GRAM ({amount} × {bets_added})
 🎯 Количество ставок: *{bets_added}*
-💳 Новый баланс: *{get_user_balance(user_id)}* GRAM
+💳 Новый баланс: *{new_balance}* GRAM
 
 📋 Используй команды:
 `ставки` - мои ставки
 `го` - начать раунд
 `отмена` - отменить все ставки
 """, parse_mode='Markdown')
-            
-            if user_id not in roulette_timers or roulette_timers[user_id] < time.time():
-                roulette_timers[user_id] = time.time() + ROULETTE_COOLDOWN
-        else:
-            bot.reply_to(message, "❌ Некорректные ставки\nДоступно: числа 0-36, к/ч, чет/нечет, диапазон (1-18)")
-        return
+        
+        if user_id not in roulette_timers or roulette_timers[user_id] < time.time():
+            roulette_timers[user_id] = time.time() + ROULETTE_COOLDOWN
+
+@bot.message_handler(content_types=['text'])
+def handle_all_messages(message):
+    start = time.perf_counter()
+    handler = resolve_text_command(message.text)
+    trace_span('parse', time.perf_counter() - start)
+    if handler:
+        with user_lock(message.from_user.id), HandlerTimer(handler.__name__):
+            handler(message)
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
+    with user_lock(call.from_user.id):
+        process_callback(call)
+
+def process_callback(call):
     data = call.data
     
     if data == "daily_bonus":
         daily_bonus_callback(call)
         return
     
+    if data.startswith('finduser_'):
+        finduser_callback(call)
+        return
+    
     if data.startswith('mines_'):
         parts = data.split('_', 2)
         
@@ -1108,45 +3137,64 @@ def handle_callback(call):
             return
         
         prefix, game_id, action = parts
+        game = get_mines_game(int(game_id)) if game_id.isdigit() else None
         
-        if game_id not in mines_games:
+        if game is None:
             bot.answer_callback_query(call.id, "❌ Игра завершена")
             return
         
-        game = mines_games[game_id]
-        
-        if game['user_id'] != call.from_user.id:
+        game_id = int(game_id)
+        if game.user_id != call.from_user.id:
             bot.answer_callback_query(call.id, "❌ Это не ваша игра!")
             return
         
+        game.touched_at = time.monotonic()
+        game.chat_id = call.message.chat.id
+        game.message_id = call.message.message_id
+        mark_mines_progress(game_id)
+        
         if action == 'cashout':
-            win_amount = game['current_payout'] - game['bet_amount']
-            update_balance(call.from_user.id, game['current_payout'])
-            add_transaction(0, call.from_user.id, win_amount, "mines_win")
+            # Игру мог уже закрыть таймер истечения
+            win_amount = game.current_payout - game.bet_amount
+            try:
+                balances = finish_mines_game(game_id, game, game.current_payout,
+                                             (0, call.from_user.id, win_amount, "mines_win"))
+            except GameSettled:
+                bot.answer_callback_query(call.id, "❌ Игра завершена")
+                return
+            if balances is None:
+                bot.answer_callback_query(call.id, "❌ Ошибка, попробуйте еще раз")
+                return
+            new_balance = balances[call.from_user.id]
             
-            multiplier = game['current_payout'] / game['bet_amount']
+            multiplier = game.current_payout / game.bet_amount
             
             bot.edit_message_text(
                 f"""
 💰 *МИНЫ | ВЫВОД*
 
 🏆 Вы успешно вывели средства!
-💰 Ставка: *{game['bet_amount']}* GRAM
+💰 Ставка: *{game.bet_amount}* GRAM
 📈 Множитель: *{multiplier:.2f}x*
-🎯 Выигрыш: *{game['current_payout']}* GRAM
+🎯 Выигрыш: *{game.current_payout}* GRAM
 💎 Прибыль: *{win_amount}* GRAM
 
-💳 Баланс: *{get_user_balance(call.from_user.id)}* GRAM
+💳 Баланс: *{new_balance}* GRAM
 """,
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
                 parse_mode='Markdown'
             )
             
-            del mines_games[game_id]
-            
         elif action == 'end':
-            del mines_games[game_id]
+            try:
+                balances = finish_mines_game(game_id, game)
+            except GameSettled:
+                bot.answer_callback_query(call.id, "❌ Игра завершена")
+                return
+            if balances is None:
+                bot.answer_callback_query(call.id, "❌ Ошибка, попробуйте еще раз")
+                return
             bot.edit_message_text(
                 "❌ Игра отменена",
                 chat_id=call.message.chat.id,
@@ -1156,38 +3204,31 @@ def handle_callback(call):
         else:
             try:
                 cell_index = int(action)
+                if not game.has_cell(cell_index):
+                    raise ValueError(action)
                 
-                if cell_index in game['revealed_cells']:
+                if game.is_revealed(cell_index):
                     bot.answer_callback_query(call.id, "❌ Уже открыта")
                     return
                 
-                if cell_index in game['mine_positions']:
-                    keyboard = []
-                    grid_size = game['grid_size']
-                    
-                    for row in range(grid_size):
-                        row_buttons = []
-                        for col in range(grid_size):
-                            cell_idx = row * grid_size + col
-                            if cell_idx in game['mine_positions']:
-                                row_buttons.append(InlineKeyboardButton("💣", callback_data="noop"))
-                            elif cell_idx == cell_index:
-                                row_buttons.append(InlineKeyboardButton("💥", callback_data="noop"))
-                            elif cell_idx in game['revealed_cells']:
-                                row_buttons.append(InlineKeyboardButton("💎", callback_data="noop"))
-                            else:
-                                row_buttons.append(InlineKeyboardButton("🟦", callback_data="noop"))
-                        keyboard.append(row_buttons)
-                    
-                    markup = InlineKeyboardMarkup(keyboard)
+                if game.is_mine(cell_index):
+                    try:
+                        balances = finish_mines_game(game_id, game)
+                    except GameSettled:
+                        bot.answer_callback_query(call.id, "❌ Игра завершена")
+                        return
+                    if balances is None:
+                        bot.answer_callback_query(call.id, "❌ Ошибка, попробуйте еще раз")
+                        return
+                    markup = mines_lost_keyboard(game, cell_index)
                     
                     bot.edit_message_text(
                         f"""
 💣 *МИНЫ | ПРОИГРЫШ*
 
-💰 Ставка: *{game['bet_amount']}* GRAM
-💣 Мин на поле: *{game['mines_count']}*
-💸 Потеряно: *{game['bet_amount']}* GRAM
+💰 Ставка: *{game.bet_amount}* GRAM
+💣 Мин на поле: *{game.mines_count}*
+💸 Потеряно: *{game.bet_amount}* GRAM
 
 😔 Вы наткнулись на мину!
 """,
@@ -1197,45 +3238,25 @@ def handle_callback(call):
                         reply_markup=markup
                     )
                     
-                    del mines_games[game_id]
-                    
                 else:
-                    game['revealed_cells'].append(cell_index)
-                    opened_safe = len(game['revealed_cells'])
+                    game.reveal(cell_index)
+                    opened_safe = game.opened
                     multiplier = get_mines_multiplier(opened_safe)
-                    new_payout = int(game['bet_amount'] * multiplier)
-                    game['current_payout'] = new_payout
-                    
-                    keyboard = []
-                    grid_size = game['grid_size']
-                    
-                    for row in range(grid_size):
-                        row_buttons = []
-                        for col in range(grid_size):
-                            cell_idx = row * grid_size + col
-                            if cell_idx in game['revealed_cells']:
-                                row_buttons.append(InlineKeyboardButton("💎", callback_data="noop"))
-                            else:
-                                row_buttons.append(InlineKeyboardButton("🟦", callback_data=f"mines_{game_id}_{cell_idx}"))
-                        keyboard.append(row_buttons)
+                    new_payout = int(game.bet_amount * multiplier)
+                    game.current_payout = new_payout
                     
-                    keyboard.append([
-                        InlineKeyboardButton("💰 Забрать", callback_data=f"mines_{game_id}_cashout"),
-                        InlineKeyboardButton("❌ Закончить", callback_data=f"mines_{game_id}_end")
-                    ])
-                    
-                    markup = InlineKeyboardMarkup(keyboard)
+                    markup = mines_reveal_keyboard(game_id, game)
                     
                     game_text = f"""
 💣 *МИНЫ | ИГРА*
 
-💰 Ставка: *{game['bet_amount']}* GRAM
-💣 Мин на поле: *{game['mines_count']}*
+💰 Ставка: *{game.bet_amount}* GRAM
+💣 Мин на поле: *{game.mines_count}*
 🎯 Открыто клеток: *{opened_safe}*
 🏆 Множитель: *{multiplier:.2f}x*
 
 💎 Выигрыш: *{new_payout}* GRAM
-💎 Прибыль: *{new_payout - game['bet_amount']}* GRAM
+💎 Прибыль: *{new_payout - game.bet_amount}* GRAM
 
 ⚠️ Выберите следующую клетку.
 """
@@ -1247,14 +3268,486 @@ def handle_callback(call):
                         reply_markup=markup
                     )
                     
-            except:
+            except Exception as e:
+                logger.error(f"Ошибка хода в мины {game_id}: {e}")
                 bot.answer_callback_query(call.id, "❌ Ошибка")
     else:
         bot.answer_callback_query(call.id)
 
-def main():
+# WEBHOOK
+update_queue = queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+
+def _update_worker():
+    while True:
+        update = update_queue.get()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+
+def create_webhook_app():
+    app = Flask(__name__)
+
+    @app.route(WEBHOOK_PATH, methods=['POST'])
+    def webhook():
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            abort(403)
+        
+        payload = request.get_json(force=True, silent=True)
+        if payload is None:
+            abort(400)
+        
+        # Для локальной проверки можно прислать сразу список обновлений
+        updates = payload if isinstance(payload, list) else [payload]
+        for data in updates:
+            received_at = time.perf_counter()
+            update = telebot.types.Update.de_json(data)
+            update.received_at = received_at
+            update.parse_seconds = time.perf_counter() - received_at
+            try:
+                update_queue.put_nowait(update)
+            except queue.Full:
+                # Telegram повторит доставку, если ответить не 2xx
+                abort(503)
+        return ''
+
+    @app.route('/', methods=['GET'])
+    def health():
+        return f'ok, в очереди: {update_queue.qsize()}'
+
+    return app
+
+def start_webhook():
+    global WEBHOOK_SECRET
+    if not WEBHOOK_SECRET:
+        if not WEBHOOK_URL:
+            # Вебхук зарегистрирован кем-то еще, а проверить отправителя нечем
+            raise SystemExit("❌ Для режима webhook нужен WEBHOOK_SECRET (или WEBHOOK_URL, тогда секрет сгенерируется)")
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+        logger.info("🔑 WEBHOOK_SECRET не задан, сгенерирован случайный")
+    
+    # Хендлеры выполняются в потоках вебхука, а не в неограниченной очереди
+    # пула TeleBot: тогда заполненный update_queue дает 503 и Telegram повторит доставку
+    bot.threaded = False
+    for i in range(UPDATE_WORKERS):
+        threading.Thread(target=_update_worker, name=f"update-worker-{i}", daemon=True).start()
+    
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        logger.info(f"🌐 Вебхук установлен: {WEBHOOK_URL}")
+    else:
+        logger.info("🌐 WEBHOOK_URL не задан, вебхук в Telegram не регистрируется")
+    return create_webhook_app()
+
+def webhook_app():
+    # WSGI-приложение для внешнего сервера. Процесс должен быть один: в нем
+    # живут леджер, планировщик и игры в памяти —
+    #   gunicorn -w 1 --threads 8 -b 0.0.0.0:8080 'bot:webhook_app()'
+    #   waitress-serve --port=8080 --call bot:webhook_app
+    start_bot()
+    return start_webhook()
+
+def run_webhook():
+    from waitress import serve
+    
+    serve(start_webhook(), host='0.0.0.0', port=PORT, threads=BOT_THREADS)
+
+# МЕТРИКИ: ГАУЖИ И HTTP
+Gauge('casino_mines_games_active', 'Незавершенные игры в мины', count_active_mines)
+Gauge('casino_roulette_bets_active', 'Принятые и не рассчитанные ставки рулетки', count_active_roulette_bets)
+Gauge('casino_roulette_tables_active', 'Столы рулетки с ожидающим раундом', lambda: len(roulette_tables))
+Gauge('casino_ledger_queue_depth', 'Операции в очереди леджера', lambda: ledger_queue.qsize())
+Gauge('casino_update_queue_depth', 'Обновления в очереди вебхука', lambda: update_queue.qsize())
+Gauge('casino_scheduler_pending', 'Задачи в планировщике', lambda: scheduler.pending())
+Gauge('casino_delivery_pending', 'Несохраненные статусы доставки и профили', lambda: len(delivery_pending) + len(profile_pending))
+Gauge('casino_user_cache_size', 'Строк в кэше пользователей', lambda: len(user_cache))
+Gauge('casino_outbox_pending', 'Сообщения в исходящей очереди', lambda: outbox.pending())
+Gauge('casino_outbox_max_chat_backlog', 'Самая длинная очередь одного чата', lambda: outbox.max_backlog())
+Gauge('casino_uptime_seconds', 'Время работы процесса', lambda: int(time.time() - START_TIME))
+
+def instrument_handlers():
+    # Зарегистрированные хендлеры TeleBot оборачиваются замером времени
+    for handlers in (bot.message_handlers, bot.callback_query_handlers, bot.my_chat_member_handlers):
+        for handler in handlers:
+            handler['function'] = timed_handler(handler['function'])
+
+instrument_handlers()
+
+def create_metrics_app():
+    app = Flask('metrics')
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    return app
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    app = create_metrics_app()
+    threading.Thread(target=lambda: app.run(host=METRICS_HOST, port=METRICS_PORT, threaded=True, use_reloader=False),
+                     name="metrics", daemon=True).start()
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+# ИСХОДЯЩАЯ ОЧЕРЕДЬ
+# Сообщения и правки уходят в очередь своего чата и отправляются пулом
+# OUTBOX_WORKERS по лимиту чата (token bucket), по одному запросу на чат за раз —
+# порядок внутри чата сохраняется. Правка сообщения, которая еще ждет в очереди,
+# заменяется новой: при частых нажатиях в минах уходит только последнее поле.
+# Хендлер получает Future и не ждет ни лимита, ни HTTP. Чат, который пишет
+# быстрее лимита, не копит очередь: сверх OUTBOX_CHAT_LIMIT новые сообщения
+# отклоняются, а не-правки старше OUTBOX_SEND_TTL выбрасываются перед отправкой —
+# ответ на давнюю команду пользователю уже не нужен. Future таких сообщений
+# завершается OutboxDropped. Итоги расчетов (notify) не отклоняются и не
+# устаревают и встают в очередь чата перед обычными ответами: в занятой группе
+# ответы на ставки не вытесняют итог раунда.
+def outbound_chat_id(name, args, kwargs):
+    if name == 'reply_to':
+        return args[0].chat.id
+    if name in ('send_message', 'get_chat'):
+        return args[0] if args else kwargs.get('chat_id')
+    if name == 'edit_message_text':
+        return args[1] if len(args) > 1 else kwargs.get('chat_id')
+    return kwargs.get('chat_id')
+
+class ChatOutbox:
+    __slots__ = ('chat_id', 'jobs', 'edits', 'rate', 'capacity', 'tokens', 'updated', 'active')
+
+    def __init__(self, chat_id):
+        # Положительные ID — личные чаты, отрицательные — группы и каналы
+        private = chat_id > 0
+        self.chat_id = chat_id
+        self.jobs = deque()
+        self.edits = {}
+        self.rate = OUTBOX_PRIVATE_RATE if private else OUTBOX_GROUP_RATE
+        self.capacity = OUTBOX_PRIVATE_BURST if private else OUTBOX_GROUP_BURST
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.active = False
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # 0 — можно отправлять сейчас, иначе сколько ждать следующего токена
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class OutboxDropped(Exception):
+    pass
+
+class Outbox:
+    METHODS = ('reply_to', 'send_message', 'edit_message_text')
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.chats = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        # Свой таймер: пробуждение очереди чата — только взять замок и отдать
+        # отправку в пул, оно не ждет за задачами общего планировщика
+        self.timer = Scheduler("outbox-timer")
+        self.methods = {}
+
+    def install(self, sync_bot):
+        # Поверх текущих методов бота (в том числе AsyncBotBridge)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox")
+        self.timer.start()
+        self.methods = {name: getattr(sync_bot, name) for name in self.METHODS}
+        for name in self.METHODS:
+            setattr(sync_bot, name, self._queued(name))
+
+    def _queued(self, name):
+        def call(*args, **kwargs):
+            return self.submit(name, args, kwargs)
+        return call
+
+    def submit(self, name, args, kwargs, priority=False):
+        if name == 'reply_to':
+            # TeleBot.reply_to сам вызывает send_message — ставим в очередь его
+            message = args[0]
+            name, args = 'send_message', (message.chat.id,) + args[1:]
+            kwargs = dict(kwargs, reply_to_message_id=message.message_id)
+        chat_id = outbound_chat_id(name, args, kwargs)
+        if chat_id is None:
+            # inline_message_id и подобное — чата нет, отправляем сразу
+            return self.methods[name](*args, **kwargs)
+        
+        message_id = kwargs.get('message_id') if name == 'edit_message_text' else None
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = ChatOutbox(chat_id)
+            
+            job = chat.edits.get(message_id) if message_id is not None else None
+            if job is not None:
+                job[1] = args
+                job[2] = kwargs
+                job[5] = job[5] or priority
+                outbox_coalesced.inc()
+                return job[3]
+            
+            if not priority and len(chat.jobs) >= OUTBOX_CHAT_LIMIT:
+                outbox_dropped.inc('full')
+                future = Future()
+                future.set_exception(OutboxDropped(f"очередь чата {chat_id} заполнена"))
+                return future
+            
+            job = [name, args, kwargs, Future(), time.monotonic(), priority]
+            if priority:
+                # После уже ожидающих итогов, перед обычными сообщениями
+                position = 0
+                while position < len(chat.jobs) and chat.jobs[position][5]:
+                    position += 1
+                chat.jobs.insert(position, job)
+            else:
+                chat.jobs.append(job)
+            if message_id is not None:
+                chat.edits[message_id] = job
+            if not chat.active:
+                chat.active = True
+                self._schedule(chat)
+        return job[3]
+
+    def _shed_stale(self, chat):
+        # Вызывается под self.lock. Правки не устаревают: они показывают текущее состояние
+        deadline = time.monotonic() - OUTBOX_SEND_TTL
+        if not any(job[0] != 'edit_message_text' and not job[5] and job[4] < deadline for job in chat.jobs):
+            return
+        fresh = deque()
+        for job in chat.jobs:
+            if job[0] != 'edit_message_text' and not job[5] and job[4] < deadline:
+                outbox_dropped.inc('stale')
+                job[3].set_exception(OutboxDropped(f"сообщение в чат {chat.chat_id} устарело"))
+            else:
+                fresh.append(job)
+        chat.jobs = fresh
+
+    def _schedule(self, chat):
+        # Вызывается под self.lock
+        self._shed_stale(chat)
+        if not chat.jobs:
+            chat.active = False
+            return
+        wait = chat.reserve()
+        if wait:
+            outbox_delayed.inc('private' if chat.chat_id > 0 else 'group')
+            self.timer.schedule(wait, self._resume, chat)
+            return
+        try:
+            self.executor.submit(self._send_next, chat)
+        except RuntimeError:
+            # Пул закрыт при выходе интерпретатора — неотправленное теряется
+            chat.active = False
+
+    def _resume(self, chat):
+        with self.lock:
+            self._schedule(chat)
+
+    def _send_next(self, chat):
+        with self.lock:
+            job = chat.jobs.popleft()
+            name, args, kwargs, future = job[:4]
+            if chat.edits.get(kwargs.get('message_id')) is job:
+                del chat.edits[kwargs['message_id']]
+        
+        try:
+            result = self.methods[name](*args, **kwargs)
+            future.set_result(sent_result(result))
+        except Exception as e:
+            future.set_exception(e)
+            if is_dead_chat_error(e):
+                mark_dead(chat.chat_id)
+            else:
+                logger.warning(f"Ошибка {name} в чат {chat.chat_id}: {e}")
+        
+        with self.lock:
+            if chat.jobs:
+                self._schedule(chat)
+            else:
+                chat.active = False
+
+    def pending(self):
+        with self.lock:
+            return sum(len(chat.jobs) for chat in self.chats.values())
+
+    def backlog(self, chat_id):
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            return len(chat.jobs) if chat else 0
+
+    def max_backlog(self):
+        with self.lock:
+            return max((len(chat.jobs) for chat in self.chats.values()), default=0)
+
+    def evict_idle(self):
+        # Чат без очереди с полным запасом токенов ничем не отличается от нового
+        now = time.monotonic()
+        with self.lock:
+            for chat_id, chat in list(self.chats.items()):
+                if not chat.active:
+                    chat.refill(now)
+                    if chat.tokens >= chat.capacity:
+                        del self.chats[chat_id]
+
+outbox = Outbox(OUTBOX_WORKERS)
+
+def notify(name, *args, **kwargs):
+    # Сообщение об уже проведенном расчете: вне лимита очереди чата и без устаревания
+    if not outbox.methods:
+        return getattr(bot, name)(*args, **kwargs)
+    return outbox.submit(name, args, kwargs, priority=True)
+
+# ASYNC РАНТАЙМ
+class AsyncBotBridge:
+    # Синхронный фасад над AsyncTeleBot. Хендлеры остаются прежними, а запросы
+    # к Telegram выполняются в event loop: ответы и правки сообщений не ждут
+    # HTTP и не держат рабочий поток, порядок отправки внутри чата сохраняется.
+    FIRE_AND_FORGET = ('reply_to', 'edit_message_text', 'answer_callback_query')
+    BLOCKING = ('send_message', 'get_me', 'get_chat')
+
+    def __init__(self, async_bot, loop):
+        self.async_bot = async_bot
+        self.loop = loop
+        self.chat_tails = {}
+
+    async def _ordered(self, chat_id, name, args, kwargs):
+        task = asyncio.current_task()
+        prev = self.chat_tails.get(chat_id) if chat_id is not None else None
+        if chat_id is not None:
+            self.chat_tails[chat_id] = task
+        try:
+            if prev is not None and not prev.done():
+                await asyncio.wait([prev])
+            start = time.perf_counter()
+            try:
+                return await getattr(self.async_bot, name)(*args, **kwargs)
+            except Exception as e:
+                telegram_errors.inc(name, str(getattr(e, 'error_code', None) or type(e).__name__))
+                raise
+            finally:
+                telegram_request_seconds.observe(time.perf_counter() - start, name)
+        finally:
+            if chat_id is not None and self.chat_tails.get(chat_id) is task:
+                del self.chat_tails[chat_id]
+
+    def _submit(self, name, args, kwargs):
+        chat_id = outbound_chat_id(name, args, kwargs)
+        return asyncio.run_coroutine_threadsafe(self._ordered(chat_id, name, args, kwargs), self.loop)
+
+    def _fire_and_forget(self, name):
+        def log_error(future):
+            if not future.cancelled() and future.exception():
+                logger.warning(f"Ошибка {name}: {future.exception()}")
+        
+        def call(*args, **kwargs):
+            future = self._submit(name, args, kwargs)
+            future.add_done_callback(log_error)
+            return future
+        return call
+
+    def _blocking(self, name):
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return self._submit(name, args, kwargs).result()
+            finally:
+                trace_span('send', time.perf_counter() - start)
+        return call
+
+    def install(self, sync_bot):
+        for name in self.FIRE_AND_FORGET:
+            setattr(sync_bot, name, self._fire_and_forget(name))
+        for name in self.BLOCKING:
+            setattr(sync_bot, name, self._blocking(name))
+
+def start_async_runtime():
+    from telebot.async_telebot import AsyncTeleBot
+    
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="async-loop", daemon=True).start()
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+    AsyncBotBridge(async_bot, loop).install(bot)
+    return async_bot, loop
+
+def _update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        # Кнопка под сообщением группы — очередь этого чата; у inline-сообщений
+        # чата нет, тогда очередь пользователя
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    return None
+
+async def async_polling(async_bot):
+    # Хендлеры (и доступ к БД) выполняются в пуле потоков, каждый занят
+    # только на время работы с БД — ожидание Telegram происходит в event loop.
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_THREADS, thread_name_prefix="handler")
+    inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+    chat_tails = {}
+    bot.threaded = False
+    
+    async def process(update, chat_id, prev):
+        # Обновления одного чата обрабатываются строго по очереди, как при polling
+        try:
+            if prev is not None and not prev.done():
+                await asyncio.wait([prev])
+            await loop.run_in_executor(executor, bot.process_new_updates, [update])
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            inflight.release()
+            if chat_tails.get(chat_id) is asyncio.current_task():
+                del chat_tails[chat_id]
+    
+    await async_bot.remove_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await async_bot.get_updates(offset=offset, timeout=20, request_timeout=30)
+        except Exception as e:
+            logger.error(f"Ошибка getUpdates: {e}")
+            await asyncio.sleep(3)
+            continue
+        
+        for update in updates:
+            offset = update.update_id + 1
+            await inflight.acquire()
+            chat_id = _update_chat_id(update)
+            chat_tails[chat_id] = loop.create_task(process(update, chat_id, chat_tails.get(chat_id)))
+
+def start_bot():
     logger.info("🚀 Бот запущен!")
-    bot.polling(none_stop=True)
+    async_bot = loop = None
+    if BOT_RUNTIME == 'async':
+        async_bot, loop = start_async_runtime()
+        logger.info("⚡ Async рантайм (AsyncTeleBot)")
+    outbox.install(bot)
+    logger.info(f"🤖 Бот: @{get_bot_identity().username}")
+    load_game_state()
+    start_progress_flusher()
+    start_metrics_server()
+    resume_broadcasts()
+    return async_bot, loop
+
+def main():
+    async_bot, loop = start_bot()
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    elif async_bot:
+        asyncio.run_coroutine_threadsafe(async_polling(async_bot), loop).result()
+    else:
+        bot.remove_webhook()
+        bot.polling(none_stop=True)
 
 if __name__ == "__main__":
     main()